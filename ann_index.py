@@ -0,0 +1,85 @@
+from collections import defaultdict
+
+import numpy as np
+from sklearn.preprocessing import normalize
+from sklearn.random_projection import SparseRandomProjection
+
+
+class LshIndex:
+    """
+    Approximate nearest neighbours index for cosine similarity using random hyperplane LSH.
+    The TF-IDF vectors are projected on n_tables*n_bits sparse random hyperplanes, the signs of every n_bits
+    projections form a bucket key, and a query is only compared exactly with the controls sharing a bucket
+    with it in at least one table.
+    """
+    def __init__(self, controls_vecs, n_tables=16, n_bits=12, random_state=0):
+        self._n_tables = n_tables
+        self._n_bits = n_bits
+        self._controls = normalize(controls_vecs).tocsr()
+        self._projection = SparseRandomProjection(n_components=n_tables * n_bits, dense_output=True,
+                                                  random_state=random_state).fit(self._controls)
+        self._powers = 1 << np.arange(n_bits, dtype=np.int64)
+        self._tables = [defaultdict(list) for _ in range(n_tables)]
+
+        for control_ind, keys in enumerate(self._keys(self._controls)):
+            for table, key in zip(self._tables, keys):
+                table[key].append(control_ind)
+        self._tables = [{key: np.array(inds) for key, inds in table.items()} for table in self._tables]
+
+    def _keys(self, vecs):
+        """
+        :return: array of shape (rows, n_tables) with the bucket key of every row in every table
+        """
+        signs = (self._projection.transform(vecs) > 0).astype(np.int64)
+        signs = signs.reshape(vecs.shape[0], self._n_tables, self._n_bits)
+        return signs @ self._powers
+
+    def candidates(self, keys):
+        buckets = [table[key] for table, key in zip(self._tables, keys) if key in table]
+        if not buckets:
+            return np.array([], dtype=np.int64)
+        return np.unique(np.concatenate(buckets))
+
+    def top_k_similar(self, schizos_vecs, k, threshold):
+        """
+        Same contract as extract_matching_controls.top_k_similar, computed over the LSH candidates only.
+        :return: generator of (schizo index, control indices sorted by descending similarity,
+                 how many of them pass the threshold)
+        """
+        schizos_vecs = normalize(schizos_vecs).tocsr()
+        for schizo_ind, keys in enumerate(self._keys(schizos_vecs)):
+            candidates = self.candidates(keys)
+            if not len(candidates):
+                yield schizo_ind, candidates, 0
+                continue
+            similarities = (schizos_vecs[schizo_ind] @ self._controls[candidates].T).toarray()[0]
+            order = np.argsort(similarities)[:-k-1:-1]
+            yield schizo_ind, candidates[order], int((similarities[order] > threshold).sum())
+
+
+def recall_report(exact_results, ann_results, k):
+    """
+    Compare approximate matches to the exact ones.
+    :param exact_results: list of (schizo index, sorted control indices, matching count) from the exact search
+    :param ann_results: same from the approximate search
+    :param k: number of controls matched per schizo
+    :return: dictionary of recall and threshold agreement statistics
+    """
+    recalls = []
+    same_matching_count = 0
+    above_threshold_recalls = []
+    for (_, exact, exact_cnt), (_, ann, ann_cnt) in zip(exact_results, ann_results):
+        exact = list(exact[:k])
+        if exact:
+            recalls.append(len(set(exact) & set(ann[:k])) / len(exact))
+        if exact_cnt:
+            # the controls passing the threshold are the first exact_cnt ones
+            above_threshold_recalls.append(len(set(exact[:exact_cnt]) & set(ann[:k])) / exact_cnt)
+        same_matching_count += exact_cnt == ann_cnt
+
+    return {
+        'schizos': len(exact_results),
+        'recall_at_k': float(np.mean(recalls)) if recalls else 1.0,
+        'recall_above_threshold': float(np.mean(above_threshold_recalls)) if above_threshold_recalls else 1.0,
+        'same_matching_count': same_matching_count / max(len(exact_results), 1),
+    }
@@ -0,0 +1,285 @@
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import time
+from argparse import ArgumentParser
+from multiprocessing.pool import Pool
+from queue import Empty
+
+from preprocess_tweets import Patterns
+from read_twitter_text import SchizophreniaCandidates
+from terms_sentiment import TermSentiment
+
+WORDS = ['today', 'coffee', 'music', 'game', 'love', 'work', 'sleep', 'friends', 'news', 'voices', 'doctor',
+         'meds', 'weekend', 'tired', 'happy', 'lol', 'really', 'think', 'people', 'never', 'always', 'feel']
+POSITIVE_PHRASES = ['i was diagnosed with schizophrenia', 'my doctor diagnosed me', 'i have been diagnosed']
+NEGATIVE_PHRASES = ['not diagnosed', 'self diagnosed', 'to get a diagnosis']
+EXTRAS = [':)', '@someone', '#mood', '1948', 'so.another', 'lol,', '😀', 'https://t.co/abc']
+
+# tweets per user in the generated histories
+POSTS_PER_USER = 100
+
+# seconds between checks that a stage's process is still alive while waiting for its result
+RESULT_POLL_SECONDS = 1
+
+
+def random_text(rnd):
+    words = [rnd.choice(WORDS) for _ in range(rnd.randint(5, 25))]
+    if rnd.random() < 0.3:
+        words.insert(rnd.randrange(len(words)), rnd.choice(EXTRAS))
+    roll = rnd.random()
+    if roll < 0.05:
+        words.insert(rnd.randrange(len(words)), rnd.choice(POSITIVE_PHRASES))
+    elif roll < 0.06:
+        words.insert(rnd.randrange(len(words)), rnd.choice(NEGATIVE_PHRASES))
+    return ' '.join(words)
+
+
+def generate_capture(path, n_tweets, seed=0):
+    """
+    Write a reproducible synthetic filter stream capture, in the format appended by the twurl service.
+    """
+    rnd = random.Random(seed)
+    created_at = 1546300800
+    with open(path, 'w', encoding='utf-8') as out:
+        for tweet_id in range(n_tweets):
+            created_at += rnd.randint(0, 3)
+            user_id = rnd.randint(1, max(n_tweets // 20, 1))
+            text = random_text(rnd)
+            tweet = {
+                'created_at': time.strftime('%a %b %d %H:%M:%S +0000 %Y', time.gmtime(created_at)),
+                'id': tweet_id,
+                'id_str': str(tweet_id),
+                'text': text[:140],
+                'user': {'id': user_id, 'id_str': str(user_id)},
+                'entities': {'hashtags': [{'text': word} for word in text.split() if word.startswith('#')]},
+            }
+            if len(text) > 140:
+                tweet['extended_tweet'] = {'full_text': text}
+            roll = rnd.random()
+            if roll < 0.3:
+                tweet['retweeted_status'] = {'id': rnd.randint(0, n_tweets)}
+            elif roll < 0.35:
+                tweet['quoted_status'] = {'id': rnd.randint(0, n_tweets)}
+            out.write(json.dumps(tweet, separators=(',', ':')))
+            out.write('\n')
+            if rnd.random() < 0.001:
+                out.write('\n')
+
+
+def generate_history(path, n_tweets, seed=0):
+    """
+    Write a reproducible synthetic users history file, in the format saved by UserTweetFetcher.
+    """
+    rnd = random.Random(seed)
+    history = {}
+    for user_ind in range(max(n_tweets // POSTS_PER_USER, 1)):
+        created_at = 1546300800.0
+        posts = []
+        for _ in range(POSTS_PER_USER):
+            created_at += rnd.randint(60, 3600)
+            posts.append((created_at, random_text(rnd).lower()))
+        history['{}{}'.format(seed, user_ind)] = {
+            'posts': posts,
+            'hashtags': [rnd.choice(WORDS) for _ in range(rnd.randint(0, 10))]
+        }
+    with open(path, 'w', encoding='utf-8') as out:
+        json.dump(history, out)
+
+
+def read_posts(history_path):
+    with open(history_path, encoding='utf-8') as f:
+        return [post[1] for user in json.load(f).values() for post in user['posts']]
+
+
+def bench_find_schizo_candidates(data, n_processes):
+    candidates = SchizophreniaCandidates([data['capture']], data['log'], data['candidates'])
+    candidates.find_schizo_candidates(high_precision=True, from_start=True, n_processes=n_processes)
+    return data['size']
+
+
+def bench_preprocess(data, n_processes):
+    posts = read_posts(data['controls'])
+    start_time = time.time()
+    if n_processes > 1:
+        with Pool(n_processes) as pool:
+            pool.map(Patterns.preprocess, posts, chunksize=1000)
+    else:
+        Patterns.preprocess_many(posts)
+    return len(posts), time.time() - start_time
+
+
+def _match_terms(posts):
+    sentiment = TermSentiment()
+    return [sentiment.contains_positive_terms(post) and not sentiment.contains_negative_terms(post)
+            for post in posts]
+
+
+def bench_term_sentiment(data, n_processes):
+    posts = read_posts(data['controls'])
+    start_time = time.time()
+    if n_processes > 1:
+        chunks = [posts[i:i+10000] for i in range(0, len(posts), 10000)]
+        with Pool(n_processes) as pool:
+            pool.map(_match_terms, chunks)
+    else:
+        _match_terms(posts)
+    return len(posts), time.time() - start_time
+
+
+def bench_get_user_tweets(data, n_processes):
+    from fake_twitter_api import FakeTwitterAPI
+    from read_users_history import UserTweetFetcher
+
+    n_users = max(data['size'] // POSTS_PER_USER, 1)
+    api = FakeTwitterAPI.generate(n_users, tweets_per_user=int(POSTS_PER_USER * 1.5), limit=10 ** 9)
+    users_path = os.path.join(data['directory'], 'fetch_users.json')
+    with open(users_path, 'w') as out:
+        json.dump({str(user_id): {} for user_id in range(n_users)}, out)
+    store_path = os.path.join(data['directory'], 'fetch_{}.jsonl'.format(n_processes))
+    skip_cache_path = os.path.join(data['directory'], 'fetch_skipped_{}.jsonl'.format(n_processes))
+    for path in [store_path, skip_cache_path]:
+        if os.path.isfile(path):
+            os.remove(path)
+
+    fetcher = UserTweetFetcher(None, os.path.join(data['directory'], 'fetch.json'), [users_path], POSTS_PER_USER,
+                               False, store_path, n_threads=n_processes, skip_cache_path=skip_cache_path)
+    fetcher.set_apis([api])
+    start_time = time.time()
+    fetcher.get_tweets()
+    fetcher.close()
+    return api.calls, time.time() - start_time
+
+
+def bench_tfidf_matching(data, n_processes):
+    import extract_matching_controls as matching
+
+    start_time = time.time()
+    # load the config once here first, a worker initializer failing would make the pool respawn workers forever
+    matching.init()
+    with Pool(processes=n_processes, initializer=matching.init) as pool:
+        controls_group, controls_hist = matching.read_group_posts([data['controls']], pool)
+        schizos_group, schizos_hist = matching.read_group_posts([data['schizos']], pool)
+    tfidf_controls, tfidf_schizos = matching.vectorize(controls_group, controls_hist, schizos_group, schizos_hist)
+    for _ in matching.top_k_similar(tfidf_schizos, tfidf_controls, 7):
+        pass
+    return len(controls_group) + len(schizos_group), time.time() - start_time
+
+
+def bench_end_to_end(data, n_processes):
+    start_time = time.time()
+    bench_find_schizo_candidates(data, n_processes)
+    bench_get_user_tweets(data, n_processes)
+    bench_tfidf_matching(data, n_processes)
+    return data['size'], time.time() - start_time
+
+
+STAGES = {
+    'find_schizo_candidates': bench_find_schizo_candidates,
+    'preprocess': bench_preprocess,
+    'term_sentiment': bench_term_sentiment,
+    'get_user_tweets': bench_get_user_tweets,
+    'tfidf_matching': bench_tfidf_matching,
+    'end_to_end': bench_end_to_end,
+}
+
+
+def _run_stage(stage, data, n_processes, queue):
+    # keep the report on stdout clean from the stages' progress prints
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        start_time = time.time()
+        result = STAGES[stage](data, n_processes)
+        items, seconds = result if isinstance(result, tuple) else (result, time.time() - start_time)
+        # ru_maxrss is in kilobytes on Linux
+        queue.put({
+            'items': items,
+            'seconds': seconds,
+            'items_per_second': items / seconds if seconds else None,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'peak_children_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        })
+    except ImportError as e:
+        queue.put({'skipped': 'missing dependency: {}'.format(e.name)})
+    except Exception as e:
+        queue.put({'error': repr(e)})
+
+
+def run_stage(stage, data, n_processes):
+    """
+    Run a stage in a fresh process, so its peak memory is measured in isolation.
+    A stage that fails, or whose process dies without a result, e.g. when it's killed for using too much memory,
+    is reported with an error instead of stopping the benchmark.
+    """
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    process = context.Process(target=_run_stage, args=(stage, data, n_processes, queue))
+    process.start()
+    while True:
+        try:
+            result = queue.get(timeout=RESULT_POLL_SECONDS)
+            break
+        except Empty:
+            if process.exitcode is not None:
+                # the result may have been sent just before the process exited
+                try:
+                    result = queue.get(timeout=RESULT_POLL_SECONDS)
+                except Empty:
+                    result = {'error': 'process exited with code {} without a result'.format(process.exitcode)}
+                break
+    process.join()
+    return result
+
+
+def prepare_data(directory, size, seed):
+    os.makedirs(directory, exist_ok=True)
+    data = {
+        'directory': directory,
+        'size': size,
+        'capture': os.path.join(directory, 'capture_{}'.format(size)),
+        'schizos': os.path.join(directory, 'schizos_{}.json'.format(size)),
+        'controls': os.path.join(directory, 'controls_{}.json'.format(size)),
+        'log': os.path.join(directory, 'candidates_{}.txt'.format(size)),
+        'candidates': os.path.join(directory, 'candidates_{}.json'.format(size)),
+    }
+    if not os.path.isfile(data['capture']):
+        generate_capture(data['capture'], size, seed)
+    if not os.path.isfile(data['schizos']):
+        # controls outnumber schizos in the real dataset
+        generate_history(data['schizos'], max(size // 8, POSTS_PER_USER), seed)
+        generate_history(data['controls'], size, seed + 1)
+    return data
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prefix_chars='--')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000], help='Number of tweets per corpus')
+    parser.add_argument('--n_processes', type=int, nargs='+', default=[1],
+                        help='Process counts to measure the scaling with')
+    parser.add_argument('--stages', type=str, nargs='+', default=list(STAGES), choices=list(STAGES),
+                        help='Stages to run')
+    parser.add_argument('--data_dir', type=str, default='bench_data',
+                        help='Directory for the generated corpora, reused across runs')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the generated corpora')
+    parser.add_argument('--output', type=str, default=None, help='Optional json output file, default is stdout')
+    options = parser.parse_args()
+
+    results = []
+    for size in options.sizes:
+        data = prepare_data(options.data_dir, size, options.seed)
+        for stage in options.stages:
+            for n_processes in options.n_processes:
+                result = {'stage': stage, 'size': size, 'n_processes': n_processes}
+                result.update(run_stage(stage, data, n_processes))
+                print(json.dumps(result), file=sys.stderr)
+                results.append(result)
+
+    report = json.dumps({'python': sys.version.split()[0], 'results': results}, indent=2)
+    if options.output:
+        with open(options.output, 'w') as out:
+            out.write(report)
+    else:
+        print(report)
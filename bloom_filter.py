@@ -0,0 +1,76 @@
+import hashlib
+import json
+import math
+import os
+
+# default number of ids a filter is sized for, and the probability of an unseen id being reported as seen
+DEFAULT_CAPACITY = 1000000
+DEFAULT_ERROR_RATE = 1e-6
+
+
+class BloomFilter:
+    """
+    Memory-bounded set of string ids, e.g. tweet ids, answering whether an id was seen before.
+    The filter takes capacity * -ln(error_rate) / ln(2)^2 bits however many ids are added, at the cost of
+    reporting an unseen id as seen with probability error_rate, which grows once more than capacity ids are added.
+    It's saved as a json header line with its parameters followed by the raw bits.
+    """
+    def __init__(self, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._n_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self._n_hashes = max(1, int(round(self._n_bits / capacity * math.log(2))))
+        self._bits = bytearray((self._n_bits + 7) // 8)
+        self._count = 0
+
+    @classmethod
+    def load(cls, path):
+        """
+        :return: the filter saved at path, with the parameters it was created with
+        """
+        with open(path, 'rb') as f:
+            header = json.loads(f.readline())
+            bloom = cls(header['capacity'], header['error_rate'])
+            bloom._count = header['count']
+            bloom._bits = bytearray(f.read())
+        if len(bloom._bits) != (bloom._n_bits + 7) // 8:
+            raise ValueError('Corrupted bloom filter file {}'.format(path))
+        return bloom
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(json.dumps({'capacity': self.capacity, 'error_rate': self.error_rate,
+                                'count': self._count}).encode('utf-8') + b'\n')
+            f.write(self._bits)
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        """
+        :return: number of added ids, not counting the ids reported as seen
+        """
+        return self._count
+
+    def _positions(self, key):
+        # double hashing of a single 128 bit digest
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self._n_bits for i in range(self._n_hashes)]
+
+    def __contains__(self, key):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def add(self, key):
+        """
+        :return: False if the key was already seen
+        """
+        seen = True
+        for position in self._positions(key):
+            byte, bit = position >> 3, 1 << (position & 7)
+            if not self._bits[byte] & bit:
+                self._bits[byte] |= bit
+                seen = False
+        if not seen:
+            self._count += 1
+        return not seen
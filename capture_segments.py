@@ -0,0 +1,261 @@
+import calendar
+import glob
+import gzip
+import io
+import json
+import os
+import re
+import shutil
+import sys
+import time
+from argparse import ArgumentParser
+
+from timestamps import parse_created_at
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# file extension of each segment compression
+COMPRESSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+# the active segment, kept uncompressed so it can be followed while it's being written
+ACTIVE_SEGMENT = 'current.jsonl'
+
+# segments are rotated after this many lines or seconds, whichever comes first
+MAX_SEGMENT_LINES = 1000000
+MAX_SEGMENT_SECONDS = 60 * 60
+
+# bytes read at once when looking for the last complete line of a segment left by a stopped run
+RECOVERY_BLOCK_SIZE = 1024 * 1024
+
+CREATED_AT_PATTERN = re.compile(r'"created_at":\s*"([^"]+)"')
+
+
+def line_created_at(line):
+    """
+    :return: creation time of a raw capture line's tweet as a unix timestamp, or None
+    """
+    match = CREATED_AT_PATTERN.search(line)
+    if not match:
+        return None
+    return parse_created_at(match.group(1))
+
+
+def parse_date(date):
+    """
+    :param date: YYYY-MM-DD date in UTC
+    :return: unix timestamp of the start of the date
+    """
+    return calendar.timegm(time.strptime(date, '%Y-%m-%d'))
+
+
+def is_compressed(path):
+    return path.endswith(tuple(COMPRESSIONS.values()))
+
+
+def open_capture(path):
+    """
+    Open a capture file for binary reading, decompressing it according to its extension.
+    """
+    if path.endswith(COMPRESSIONS['gzip']):
+        return gzip.open(path, 'rb')
+    if path.endswith(COMPRESSIONS['zstd']):
+        if zstandard is None:
+            raise ImportError('zstandard is required to read {}'.format(path), name='zstandard')
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True, read_across_frames=True)
+        return io.BufferedReader(reader)
+    return open(path, 'rb')
+
+
+def compress_file(input_path, output_path, compression):
+    with open(input_path, 'rb') as f_in:
+        if compression == 'gzip':
+            with gzip.open(output_path, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+        else:
+            if zstandard is None:
+                raise ImportError('zstandard is required for zstd compression', name='zstandard')
+            with open(output_path, 'wb') as f_out:
+                zstandard.ZstdCompressor(level=10).copy_stream(f_in, f_out)
+
+
+class CaptureSegments:
+    """
+    Directory of rotated capture segments.
+    Completed segments are compressed and listed in manifest.json with their line count
+    and the creation time range of their tweets, which lets readers skip segments outside a time window.
+    The active segment is not listed until it's rotated.
+    """
+    def __init__(self, directory):
+        self._directory = directory
+
+    @staticmethod
+    def is_segment_directory(path):
+        return os.path.isfile(os.path.join(path, 'manifest.json'))
+
+    def _path(self, name):
+        return os.path.join(self._directory, name)
+
+    def manifest(self):
+        if not os.path.isfile(self._path('manifest.json')):
+            return {'segments': []}
+        with open(self._path('manifest.json')) as f:
+            return json.load(f)
+
+    def _write_manifest(self, manifest):
+        tmp_path = self._path('manifest.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp_path, self._path('manifest.json'))
+
+    def segments(self, since=None, until=None):
+        """
+        :param since: optional unix timestamp, segments with only older tweets are skipped
+        :param until: optional unix timestamp, segments with only newer tweets are skipped
+        :return: paths of the completed segments overlapping the time window, oldest first
+        """
+        paths = []
+        for segment in self.manifest()['segments']:
+            if since is not None and segment['last_created_at'] is not None and segment['last_created_at'] < since:
+                continue
+            if until is not None and segment['first_created_at'] is not None and segment['first_created_at'] > until:
+                continue
+            paths.append(self._path(segment['file']))
+        return paths
+
+    def add_segment(self, input_path, compression, n_lines, first_created_at, last_created_at):
+        """
+        Compress a finished segment into the directory and list it in the manifest.
+        The manifest is updated last, so readers never see a partially written segment.
+        The segment is listed with its input file name, and an input already listed isn't added again,
+        so a segment can be added again safely when its input wasn't removed after it was added.
+        """
+        manifest = self.manifest()
+        source = os.path.basename(input_path)
+        if any(segment.get('source') == source for segment in manifest['segments']):
+            return
+        name = 'segment-{:06d}.jsonl{}'.format(len(manifest['segments']), COMPRESSIONS[compression])
+        compress_file(input_path, self._path(name), compression)
+        manifest['segments'].append({
+            'file': name,
+            'lines': n_lines,
+            'first_created_at': first_created_at,
+            'last_created_at': last_created_at,
+            'bytes': os.path.getsize(self._path(name)),
+            'source': source,
+        })
+        self._write_manifest(manifest)
+
+
+class SegmentWriter:
+    """
+    Append a capture stream to the active segment of a CaptureSegments directory,
+    rotating it into a compressed segment every max_lines lines or max_seconds seconds.
+    """
+    def __init__(self, directory, compression='gzip', max_lines=MAX_SEGMENT_LINES, max_seconds=MAX_SEGMENT_SECONDS):
+        os.makedirs(directory, exist_ok=True)
+        self._segments = CaptureSegments(directory)
+        self._active_path = os.path.join(directory, ACTIVE_SEGMENT)
+        self._compression = compression
+        self._max_lines = max_lines
+        self._max_seconds = max_seconds
+        self._out = None
+        self._recover()
+        self._open()
+
+    def _recover(self):
+        """
+        Rotate the segments left by a previous run that was stopped while writing or compressing them.
+        """
+        for path in sorted(glob.glob(glob.escape(self._active_path) + '.*.rotated')) + [self._active_path]:
+            if not os.path.isfile(path):
+                continue
+            with open(path, 'r+b') as f:
+                # drop the last line if it was cut off
+                end = f.seek(0, os.SEEK_END)
+                while end > 0:
+                    start = max(end - RECOVERY_BLOCK_SIZE, 0)
+                    f.seek(start)
+                    newline = f.read(end - start).rfind(b'\n')
+                    if newline >= 0:
+                        end = start + newline + 1
+                        break
+                    end = start
+                f.truncate(end)
+
+            self._n_lines = 0
+            self._first_created_at = None
+            self._last_created_at = None
+            with open(path, 'rb') as f:
+                for line in f:
+                    self._count(line.decode('utf-8'))
+            self._rotate(path)
+
+    def _open(self):
+        self._out = open(self._active_path, 'ab')
+        self._opened_at = time.time()
+        self._n_lines = 0
+        self._first_created_at = None
+        self._last_created_at = None
+
+    def _count(self, line):
+        self._n_lines += 1
+        created_at = line_created_at(line)
+        if created_at is not None:
+            if self._first_created_at is None or created_at < self._first_created_at:
+                self._first_created_at = created_at
+            if self._last_created_at is None or created_at > self._last_created_at:
+                self._last_created_at = created_at
+
+    def _rotate(self, path=None):
+        if self._out:
+            self._out.close()
+            self._out = None
+        path = path or self._active_path
+        if self._n_lines:
+            # move the active segment away first, so followers see a rotation instead of a truncation,
+            # under a name of its own, so the manifest tells whether it was added before a stop
+            rotated_path = path
+            if path == self._active_path:
+                rotated_path = '{}.{}.rotated'.format(self._active_path, time.time_ns())
+                os.replace(path, rotated_path)
+            self._segments.add_segment(rotated_path, self._compression, self._n_lines,
+                                       self._first_created_at, self._last_created_at)
+            os.remove(rotated_path)
+        elif os.path.isfile(path):
+            os.remove(path)
+
+    def write(self, line):
+        """
+        :param line: raw capture line including its newline
+        """
+        self._out.write(line.encode('utf-8'))
+        self._out.flush()
+        self._count(line)
+        if self._n_lines >= self._max_lines or time.time() - self._opened_at >= self._max_seconds:
+            self._rotate()
+            self._open()
+
+    def close(self):
+        self._rotate()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prefix_chars='--')
+    parser.add_argument('--output', type=str, required=True,
+                        help='Segments directory to write the capture stream read from stdin to')
+    parser.add_argument('--compression', type=str, default='gzip', choices=list(COMPRESSIONS),
+                        help='Compression of the rotated segments')
+    parser.add_argument('--max_lines', type=int, default=MAX_SEGMENT_LINES, help='Maximal lines per segment')
+    parser.add_argument('--max_seconds', type=int, default=MAX_SEGMENT_SECONDS, help='Maximal seconds per segment')
+    options = parser.parse_args()
+
+    writer = SegmentWriter(options.output, options.compression, options.max_lines, options.max_seconds)
+    try:
+        for line in sys.stdin:
+            if line.endswith('\n'):
+                writer.write(line)
+    finally:
+        writer.close()
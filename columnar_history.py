@@ -0,0 +1,176 @@
+import json
+import mmap
+import os
+from argparse import ArgumentParser
+from array import array
+
+import fast_json
+
+# column files, their array typecodes (None for raw utf-8 bytes)
+COLUMNS = {
+    'user_post_offsets': 'q',
+    'timestamps': 'd',
+    'text_offsets': 'q',
+    'texts': None,
+    'hashtag_offsets': 'q',
+    'hashtags': None,
+}
+
+
+class ColumnarHistoryWriter:
+    """
+    Write users' history in the columnar format read by ColumnarHistory, one user at a time.
+    """
+    def __init__(self, directory):
+        self._directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._files = {name: open(os.path.join(directory, name), 'wb') for name in COLUMNS}
+        self._ids = open(os.path.join(directory, 'user_ids.txt'), 'w', encoding='utf-8')
+        self._n_users = 0
+        self._n_posts = 0
+        self._text_bytes = 0
+        self._hashtag_bytes = 0
+        array('q', [0]).tofile(self._files['user_post_offsets'])
+        array('q', [0]).tofile(self._files['text_offsets'])
+        array('q', [0]).tofile(self._files['hashtag_offsets'])
+
+    def add_user(self, user_id, user_data):
+        """
+        :param user_id: Twitter id of the user
+        :param user_data: dictionary with the user's 'posts' as (created_at, text) and 'hashtags'
+        """
+        timestamps = array('d')
+        text_offsets = array('q')
+        texts = []
+        for created_at, text in user_data['posts']:
+            text = text.encode('utf-8')
+            self._text_bytes += len(text)
+            timestamps.append(created_at)
+            text_offsets.append(self._text_bytes)
+            texts.append(text)
+        self._n_posts += len(timestamps)
+
+        hashtags = '\n'.join(user_data['hashtags']).encode('utf-8')
+        self._hashtag_bytes += len(hashtags)
+
+        timestamps.tofile(self._files['timestamps'])
+        text_offsets.tofile(self._files['text_offsets'])
+        self._files['texts'].write(b''.join(texts))
+        self._files['hashtags'].write(hashtags)
+        array('q', [self._n_posts]).tofile(self._files['user_post_offsets'])
+        array('q', [self._hashtag_bytes]).tofile(self._files['hashtag_offsets'])
+        self._ids.write('{}\n'.format(user_id))
+        self._n_users += 1
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._ids.close()
+        with open(os.path.join(self._directory, 'meta.json'), 'w') as f:
+            json.dump({'n_users': self._n_users, 'n_posts': self._n_posts}, f)
+
+
+class ColumnarHistory:
+    """
+    Memory-mapped reader of users' history in columnar format: user ids, per user offsets into the posts,
+    post timestamps as a float64 array and post texts in one contiguous utf-8 buffer.
+    Processes opening the same files share their pages, and only the accessed posts are decoded.
+    """
+    def __init__(self, directory):
+        self._directory = directory
+        with open(os.path.join(directory, 'meta.json')) as f:
+            self._meta = json.load(f)
+        with open(os.path.join(directory, 'user_ids.txt'), encoding='utf-8') as f:
+            self._user_ids = f.read().splitlines()
+        self._index = None
+        self._maps = []
+        self._columns = {name: self._map(name, typecode) for name, typecode in COLUMNS.items()}
+
+    @staticmethod
+    def is_columnar(path):
+        return os.path.isfile(os.path.join(path, 'meta.json')) and \
+            os.path.isfile(os.path.join(path, 'user_post_offsets'))
+
+    def _map(self, name, typecode):
+        path = os.path.join(self._directory, name)
+        if not os.path.getsize(path):
+            return memoryview(b'').cast(typecode) if typecode else b''
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mapped)
+        view = memoryview(mapped)
+        return view.cast(typecode) if typecode else view
+
+    def __len__(self):
+        return self._meta['n_users']
+
+    def __contains__(self, user_id):
+        return user_id in self.index
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = {user_id: i for i, user_id in enumerate(self._user_ids)}
+        return self._index
+
+    def user_ids(self):
+        return self._user_ids
+
+    def texts(self, user_ind, limit=None):
+        """
+        :return: list of the user's post texts, optionally only the first limit ones
+        """
+        start, end = self._columns['user_post_offsets'][user_ind:user_ind+2]
+        if limit is not None:
+            end = min(end, start + limit)
+        offsets = self._columns['text_offsets'][start:end+1]
+        texts = self._columns['texts']
+        return [str(texts[offsets[i]:offsets[i+1]], 'utf-8') for i in range(end - start)]
+
+    def posts(self, user_ind, limit=None):
+        """
+        :return: list of the user's posts as (created_at, text)
+        """
+        start = self._columns['user_post_offsets'][user_ind]
+        texts = self.texts(user_ind, limit)
+        return list(zip(self._columns['timestamps'][start:start+len(texts)], texts))
+
+    def hashtags(self, user_ind):
+        start, end = self._columns['hashtag_offsets'][user_ind:user_ind+2]
+        if start == end:
+            return []
+        return str(self._columns['hashtags'][start:end], 'utf-8').split('\n')
+
+    def items(self):
+        """
+        :return: generator of (user_id, user_data) in the same shape as the json history files
+        """
+        for i, user_id in enumerate(self._user_ids):
+            yield user_id, {'posts': self.posts(i), 'hashtags': self.hashtags(i)}
+
+
+def convert(input_path, output_directory):
+    """
+    Convert a json history file, or a UserStore jsonl file, to the columnar format.
+    The store is opened read only, so it can be converted while the fetcher is still appending to it.
+    """
+    if input_path.endswith('.jsonl'):
+        from user_store import UserStore
+        users = UserStore(input_path, readonly=True).items()
+    else:
+        users = fast_json.load_file(input_path).items()
+
+    writer = ColumnarHistoryWriter(output_directory)
+    for user_id, user_data in users:
+        writer.add_user(user_id, user_data)
+    writer.close()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prefix_chars='--')
+    parser.add_argument('--input', type=str, required=True,
+                        help='History json file, or the fetcher jsonl store, to convert')
+    parser.add_argument('--output', type=str, required=True, help='Output directory of the columnar history')
+    options = parser.parse_args()
+
+    convert(options.input, options.output)
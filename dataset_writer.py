@@ -0,0 +1,77 @@
+import json
+import os
+
+SCHIZO_LABEL = 'schizophrenia'
+CONTROL_LABEL = 'control'
+
+
+class DatasetWriter:
+    """
+    Streaming writer of the TSSD jsonl output.
+    Every schizo is written together with its controls as soon as they are matched,
+    users already in the output are skipped, and a half-finished output can be resumed.
+    """
+    def __init__(self, path, resume=False):
+        self._seen_users = set()
+        self.done_schizos = set()
+
+        if resume and os.path.isfile(path):
+            self._load(path)
+        else:
+            open(path, 'w').close()
+        self._out = open(path, 'a', encoding='utf-8')
+
+    def _load(self, path):
+        offset = 0
+        # start of the last schizo record, its controls may not all have been written
+        last_schizo_offset = None
+        seen_users = []
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                record = json.loads(line)
+                if SCHIZO_LABEL in record['label']:
+                    last_schizo_offset = offset
+                    last_schizo_index = len(seen_users)
+                seen_users.append((record['id'], SCHIZO_LABEL in record['label']))
+                offset += len(line)
+
+        if last_schizo_offset is not None:
+            # redo the last schizo group
+            offset = last_schizo_offset
+            seen_users = seen_users[:last_schizo_index]
+        with open(path, 'r+b') as f:
+            f.truncate(offset)
+
+        for user_id, is_schizo in seen_users:
+            self._seen_users.add(user_id)
+            if is_schizo:
+                self.done_schizos.add(user_id)
+        print('Resuming with {} users already written, {} of them schizophrenics'.format(
+            len(self._seen_users), len(self.done_schizos)))
+
+    def _record(self, user_id, label, posts):
+        if user_id in self._seen_users:
+            return ''
+        self._seen_users.add(user_id)
+        return json.dumps({
+            "id": user_id,
+            "label": [label],
+            "posts": [{"text": post} for post in posts]
+        }) + '\n'
+
+    def write_group(self, schizo_user, control_users):
+        """
+        Write a schizo and its matched controls.
+        :param schizo_user: tuple of (user_id, posts)
+        :param control_users: list of (user_id, posts)
+        """
+        lines = [self._record(schizo_user[0], SCHIZO_LABEL, schizo_user[1])]
+        lines += [self._record(user_id, CONTROL_LABEL, posts) for user_id, posts in control_users]
+        self._out.write(''.join(lines))
+        self._out.flush()
+        self.done_schizos.add(schizo_user[0])
+
+    def close(self):
+        self._out.close()
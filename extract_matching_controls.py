@@ -1,17 +1,36 @@
 import argparse
 import json
-from multiprocessing import Manager
+import os
+import time
+from itertools import islice
 from multiprocessing.pool import Pool
-from tqdm import tqdm
 
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfVectorizer
+from sklearn.preprocessing import normalize
+from tqdm import tqdm
 
+import fast_json
+from ann_index import LshIndex, recall_report
+from columnar_history import ColumnarHistory
+from dataset_writer import DatasetWriter
+from preprocess_cache import PreprocessCache, preprocess_cached
+from tfidf_store import TfidfStore
 from preprocess_tweets import Patterns
 from terms_sentiment import TermSentiment
+from user_store import UserStore
 
 user_id_to_matching_controls = {}
 
+SIMILARITY_THRESHOLD = 0.2
+# share of out of vocabulary tokens in new documents from which a refit is suggested
+VOCABULARY_DRIFT = 0.1
+# upper bound of the dense similarities block computed at once
+MAX_BLOCK_BYTES = 256 * 1024 * 1024
+# maximal schizo rows matched at once, the controls are read in blocks once per block of schizos
+SCHIZOS_BLOCK_ROWS = 8192
+
 
 SCHIZO_WORDS = ["schizophrenia", "schizophrenic", "paranoid schizophrenia", "paranoid schizophrenic", "schiizophrenia",
                 "schitzo", "schitzophrenia", "schizo", "schizofrenia", "schizophernia", "schizophren", "schizophrene",
@@ -20,83 +39,335 @@ SCHIZO_WORDS = ["schizophrenia", "schizophrenic", "paranoid schizophrenia", "par
                 "shizophrenic", "skitsafrantic", "skitzafrenic", "skitzophrenia", "unspecified schizophrenia"]
 
 
-def insert_user_to_output_json(user_id, label, posts, out_json):
-    # skip users (controls) which are already in
-    if user_id in output_dataset:
-        return
+# users sent to a worker at once
+USERS_CHUNK_SIZE = 64
+# users read ahead of the workers, Pool.imap alone would read all of a history's users into its task queue
+USERS_BATCH_SIZE = 64 * USERS_CHUNK_SIZE
 
-    out_json.append({
-        "id": user_id,
-        "label": [label],
-        "posts": [{"text": post} for post in posts]
-    })
+# number of hashed features of the streaming vectorizer
+HASHING_FEATURES = 2 ** 20
+# users vectorized and appended to the on-disk matrix at once by the streaming vectorizer
+VECTORIZE_CHUNK_SIZE = 2000
 
+sentiment = None
+preprocess_cache = None
+columnar_histories = {}
 
-posts = []
-group_dict = []
 
+def init(cache_path=None):
+    # per worker state, created once instead of once per user
+    global sentiment
+    global preprocess_cache
+    sentiment = TermSentiment()
+    if cache_path:
+        preprocess_cache = PreprocessCache(cache_path, readonly=True)
 
-def init(*args):
-    global posts
-    global group_dict
-    posts = args[0]
-    group_dict = args[1]
 
+def get_posts(args):
+    user_id, user_posts = args
+    user_preprocessed_posts, new_entries, hit_keys = preprocess_cached(
+        user_posts, Patterns.preprocess_many, sentiment, preprocess_cache)
+    user_preprocessed_filtered_posts = [post for post, positive, _ in user_preprocessed_posts
+                                        if not positive and post not in SCHIZO_WORDS]
+    return user_id, user_preprocessed_filtered_posts, new_entries, hit_keys
 
-def get_posts(*args):
-    index, (user_id, user_history) = args[0]
-    user_posts = [p[1] for p in user_history["posts"][:100]]
-    user_preprocessed_posts = [Patterns.preprocess(post) for post in user_posts]
-    sentiment = TermSentiment()
-    user_preprocessed_filtered_posts = [post for post in user_preprocessed_posts
-                                        if not sentiment.contains_positive_terms(post) and post not in SCHIZO_WORDS]
-    group_dict[index] = (user_id, user_preprocessed_filtered_posts)
-    posts.append('\n'.join([p.strip() for p in user_preprocessed_filtered_posts]))
 
+def get_columnar_posts(args):
+    # workers map the columnar history themselves, so only the user index is sent to them
+    hist_path, user_ind = args
+    if hist_path not in columnar_histories:
+        columnar_histories[hist_path] = ColumnarHistory(hist_path)
+    hist = columnar_histories[hist_path]
+    return get_posts((hist.user_ids()[user_ind], hist.texts(user_ind, limit=100)))
+
+
+def imap_batches(pool, func, iterable):
+    """
+    Pool.imap reading at most two batches of USERS_BATCH_SIZE items of the iterable ahead of the results,
+    the next batch is sent to the workers while the results of the current one are consumed.
+    """
+    iterator = iter(iterable)
+    pending = None
+    while True:
+        batch = list(islice(iterator, USERS_BATCH_SIZE))
+        results = pool.imap(func, batch, chunksize=USERS_CHUNK_SIZE) if batch else None
+        if pending is not None:
+            yield from pending
+        if results is None:
+            return
+        pending = results
+
+
+def iter_group_posts(history_files, pool, cache=None):
+    """
+    Stream the preprocessed posts of a group's users.
+    :param history_files: a list of paths to group Twitter history files, either json, UserStore jsonl
+                          or columnar history directories
+    :param pool: worker pool, initialized with init
+    :param cache: optional PreprocessCache the workers read from, new entries are written to it here
+    :return: generator of (user_id, preprocessed posts) in the order of the history files
+    """
+    for hist_file in history_files:
+        if ColumnarHistory.is_columnar(hist_file):
+            users_cnt = len(ColumnarHistory(hist_file))
+            results = imap_batches(pool, get_columnar_posts, ((hist_file, i) for i in range(users_cnt)))
+        elif hist_file.endswith('.jsonl'):
+            # the store is read one user at a time
+            store = UserStore(hist_file, readonly=True)
+            users_cnt = len(store)
+            users = ((user_id, [p[1] for p in user_history["posts"][:100]]) for user_id, user_history in store.items())
+            results = imap_batches(pool, get_posts, users)
+        else:
+            hist = fast_json.load_file(hist_file)
+            users_cnt = len(hist)
+            # only the posts we use are sent to the workers
+            users = ((user_id, [p[1] for p in user_history["posts"][:100]]) for user_id, user_history in hist.items())
+            results = imap_batches(pool, get_posts, users)
+
+        for user_id, user_posts, new_entries, hit_keys in tqdm(results, total=users_cnt,
+                                                                desc='Reading {}'.format(hist_file)):
+            if cache is not None:
+                cache.put_many(new_entries)
+                cache.touch(hit_keys)
+            yield user_id, user_posts
+        if cache is not None:
+            cache.commit()
 
-def read_group_posts(history_files, group_dict):
+
+def join_posts(user_posts):
+    return '\n'.join([p.strip() for p in user_posts])
+
+
+def read_group_posts(history_files, pool, cache=None):
     """
     Each user is represented by a list of strings which are their posts.
     The posts go through preprocessing.
-    :param history_files: a list of paths to group Twitter history file
-    :param group_dict: group dictionary to insert the preprocessed posts to
-    :return: List of lists representing a list of user posts
+    :param history_files: a list of paths to group Twitter history files, see iter_group_posts
+    :param pool: worker pool, initialized with init
+    :param cache: optional PreprocessCache the workers read from, new entries are written to it here
+    :return: tuple of (list of (user_id, preprocessed posts), list of each user's posts joined to one document),
+             both in the order of the history files
     """
-    posts = manager.list()
+    group = []
+    posts = []
+    for user_id, user_posts in iter_group_posts(history_files, pool, cache):
+        group.append((user_id, user_posts))
+        posts.append(join_posts(user_posts))
+    return group, posts
 
-    def update(*args):
-        pbar.update()
 
-    last_index = 0
-    for hist_file in history_files:
-        with open(hist_file) as f:
-            hist = json.load(f)
-        pool = Pool(processes=6, initializer=init, initargs=(posts, group_dict))
-        indices = range(last_index, last_index+len(hist))
-        pbar = tqdm(zip(indices, hist.items()), total=len(hist.items()), desc='Reading {}'.format(hist_file))
-        for item in zip(indices, hist.items()):
-            pool.apply_async(get_posts, args=(item,), callback=update)
-        last_index = item[0]+1
-        pool.close()
-        pool.join()
-        pbar.close()
-    return posts
-
-
-def get_similar_controls(schizo_ind, schizo_vec):
-    similarities = cosine_similarity(schizo_vec, tfidf_controls)
-    sorted_similarities = similarities[0].argsort()[:-args.matching_controls_cnt-1: -1]
-    filtered_sorted_similarities = [sim for sim in sorted_similarities if similarities[0][sim] > 0.2]
-    matching_controls_num = len(filtered_sorted_similarities)
+class StoredGroup:
+    """
+    A group of users whose preprocessed posts are kept on disk, in a UserStore written by vectorize_streaming.
+    Indexing it reads a single user, as indexing the in-memory list of (user_id, preprocessed posts) would return.
+    """
+    def __init__(self, path, ids):
+        self.ids = ids
+        self._store = UserStore(path, readonly=True)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        user_id = self.ids[i]
+        return user_id, self._store.get(user_id)['posts']
+
+    def select(self, indices):
+        """
+        :return: StoredGroup of the users at the given indices
+        """
+        group = StoredGroup.__new__(StoredGroup)
+        group.ids = [self.ids[i] for i in indices]
+        group._store = self._store
+        return group
+
+
+def vectorize_incremental(store, group_name, group, hist, vectorizer):
+    """
+    Get the TF-IDF vectors of a group, vectorizing only users missing from the store and appending them to it.
+    :param store: TfidfStore
+    :param group_name: name of the group in the store
+    :param group: list of (user_id, preprocessed posts)
+    :param hist: list of each user's posts joined to one document
+    :param vectorizer: the store's fitted vectorizer
+    :return: csr matrix with a row per user of the group, in the group's order
+    """
+    stored_ids, _ = store.load_group(group_name)
+    index = {user_id: i for i, user_id in enumerate(stored_ids)}
+    new_users = [i for i, (user_id, _) in enumerate(group) if user_id not in index]
+
+    if new_users:
+        new_docs = [hist[i] for i in new_users]
+        analyzer = vectorizer.build_analyzer()
+        tokens = [token for doc in new_docs for token in analyzer(doc)]
+        unknown = sum(token not in vectorizer.vocabulary_ for token in tokens)
+        print('{}: vectorizing {} new users, {:.1%} of their tokens are missing from the vocabulary{}'.format(
+            group_name, len(new_users), unknown / max(len(tokens), 1),
+            ', consider --tfidf_mode refit' if unknown > VOCABULARY_DRIFT * len(tokens) else ''))
+        new_ids = [group[i][0] for i in new_users]
+        store.append_group(group_name, new_ids, vectorizer.transform(new_docs))
+        for user_id in new_ids:
+            index[user_id] = len(index)
+
+    _, matrix = store.load_group(group_name)
+    return matrix[[index[user_id] for user_id, _ in group]]
+
 
+def vectorize(controls_group, controls_hist, schizos_group, schizos_hist, tfidf_dir=None, tfidf_mode='refit'):
+    """
+    :return: tuple of (controls TF-IDF matrix, schizos TF-IDF matrix)
+    """
+    controls_cnt = len(controls_hist)
+    store = TfidfStore(tfidf_dir) if tfidf_dir else None
+
+    if store and tfidf_mode == 'incremental' and store.exists():
+        vectorizer = store.load_model()
+        return (vectorize_incremental(store, 'controls', controls_group, controls_hist, vectorizer),
+                vectorize_incremental(store, 'schizos', schizos_group, schizos_hist, vectorizer))
+
+    vectorizer = TfidfVectorizer()
+    tfidf = vectorizer.fit_transform(controls_hist + schizos_hist)
+    tfidf_controls = tfidf[0:controls_cnt]
+    tfidf_schizos = tfidf[controls_cnt:]
+    if store:
+        store.save_model(vectorizer)
+        store.append_group('controls', [user_id for user_id, _ in controls_group], tfidf_controls)
+        store.append_group('schizos', [user_id for user_id, _ in schizos_group], tfidf_schizos)
+    return tfidf_controls, tfidf_schizos
+
+
+def vectorize_streaming(groups, pool, tfidf_dir, cache=None, n_features=HASHING_FEATURES):
+    """
+    Out-of-core TF-IDF vectorization using feature hashing.
+    Users are read from the history files and vectorized in chunks of VECTORIZE_CHUNK_SIZE, so neither the
+    documents nor a vocabulary are ever held in memory. The hashed term counts of each chunk are appended to the
+    group's matrix in tfidf_dir and their document frequencies are accumulated, and the preprocessed posts are
+    written to a UserStore next to the matrix for the dataset writer. The IDF weights are computed from the
+    document frequencies of all groups once they're read, as TfidfVectorizer would, and are applied to each
+    block of rows as it's matched, see top_k_similar.
+    :param groups: list of (group name, list of history files)
+    :param pool: worker pool, initialized with init
+    :param tfidf_dir: directory to write the matrices and posts to, any previous content is replaced
+    :param cache: optional PreprocessCache
+    :param n_features: number of hashed features
+    :return: tuple of (list of (StoredGroup, StoredMatrix of the term counts) in the order of groups,
+             IDF weights)
+    """
+    store = TfidfStore(tfidf_dir)
+    store.create_hashing(n_features)
+    vectorizer = HashingVectorizer(n_features=n_features, alternate_sign=False, norm=None)
+    document_frequency = np.zeros(n_features, dtype=np.int64)
+    n_documents = 0
+
+    def append_chunk(name, ids, docs):
+        counts = vectorizer.transform(docs)
+        # the hashed counts hold every feature of a row once, so each index is a document occurrence
+        document_frequency[:] += np.bincount(counts.indices, minlength=n_features)
+        store.append_group(name, ids, counts)
+
+    posts_paths = []
+    for name, history_files in groups:
+        posts_path = os.path.join(tfidf_dir, '{}_posts.jsonl'.format(name))
+        if os.path.isfile(posts_path):
+            os.remove(posts_path)
+        posts_store = UserStore(posts_path, sync=False)
+        ids, docs = [], []
+        for user_id, user_posts in iter_group_posts(history_files, pool, cache):
+            posts_store.append(user_id, {'posts': user_posts})
+            ids.append(user_id)
+            docs.append(join_posts(user_posts))
+            if len(docs) == VECTORIZE_CHUNK_SIZE:
+                append_chunk(name, ids, docs)
+                n_documents += len(docs)
+                ids, docs = [], []
+        if docs:
+            append_chunk(name, ids, docs)
+            n_documents += len(docs)
+        posts_store.close()
+        posts_paths.append(posts_path)
+
+    # smoothed IDF, as computed by TfidfVectorizer
+    store.save_idf(np.log((1 + n_documents) / (1 + document_frequency)) + 1)
+    return ([(StoredGroup(posts_path, store.group_ids(name)), store.load_group(name)[1])
+             for (name, _), posts_path in zip(groups, posts_paths)], store.load_idf())
+
+
+def row_block(matrix, start, end, weights=None):
+    """
+    Copy rows of a csr matrix or of a StoredMatrix, whose memory-mapped arrays are only read for the rows.
+    :param weights: optional per feature weights the values are multiplied by, e.g. IDF weights of term counts
+    :return: csr matrix of the rows start to end
+    """
+    indptr = np.asarray(matrix.indptr[start:end+1])
+    data = np.asarray(matrix.data[indptr[0]:indptr[-1]])
+    indices = np.asarray(matrix.indices[indptr[0]:indptr[-1]])
+    if weights is not None:
+        data = data * weights[indices]
+    return csr_matrix((data, indices, indptr - indptr[0]), shape=(end - start, matrix.shape[1]))
+
+
+def top_k_similar(schizos_vecs, controls_vecs, k, weights=None):
+    """
+    Find the k most cosine similar controls of every schizo.
+    Blocks of up to SCHIZOS_BLOCK_ROWS schizos are multiplied against blocks of controls, with the block sizes
+    bounded so the dense similarities block fits in MAX_BLOCK_BYTES, and the k best controls of every schizo
+    are kept while the control blocks are read. Only one block of each matrix is held in memory at once,
+    so the matrices can be memory-mapped and larger than memory.
+    :param schizos_vecs: csr matrix or StoredMatrix of schizo vectors
+    :param controls_vecs: csr matrix or StoredMatrix of control vectors
+    :param k: number of controls to find
+    :param weights: optional per feature weights applied to both matrices, e.g. IDF weights of term counts
+    :return: generator of (schizo index, control indices sorted by descending similarity,
+             how many of them pass SIMILARITY_THRESHOLD)
+    """
+    schizos_cnt = schizos_vecs.shape[0]
+    controls_cnt = controls_vecs.shape[0]
+    k = min(k, controls_cnt)
+    if k == 0:
+        for i in range(schizos_cnt):
+            yield i, np.zeros(0, dtype=np.int64), 0
+        return
+    schizos_block_size = min(max(schizos_cnt, 1), SCHIZOS_BLOCK_ROWS)
+    controls_block_size = max(1, MAX_BLOCK_BYTES // (8 * schizos_block_size))
+
+    for start in range(0, schizos_cnt, schizos_block_size):
+        schizos_block = normalize(row_block(schizos_vecs, start, min(start + schizos_block_size, schizos_cnt),
+                                            weights))
+        top = np.zeros((schizos_block.shape[0], 0), dtype=np.int64)
+        top_similarities = np.zeros((schizos_block.shape[0], 0))
+        for controls_start in range(0, controls_cnt, controls_block_size):
+            controls_end = min(controls_start + controls_block_size, controls_cnt)
+            controls_block = normalize(row_block(controls_vecs, controls_start, controls_end, weights))
+            similarities = (schizos_block @ controls_block.T).toarray()
+            candidates = np.arange(controls_start, controls_end)[None, :]
+            if similarities.shape[1] > k:
+                # keep the k best of the block before merging them into the running top
+                candidates = np.argpartition(similarities, similarities.shape[1]-k, axis=1)[:, -k:]
+                similarities = np.take_along_axis(similarities, candidates, axis=1)
+                candidates += controls_start
+            similarities = np.hstack([top_similarities, similarities])
+            candidates = np.hstack([top, np.broadcast_to(candidates, similarities.shape[:1] + candidates.shape[1:])])
+            if similarities.shape[1] > k:
+                best = np.argpartition(similarities, similarities.shape[1]-k, axis=1)[:, -k:]
+                similarities = np.take_along_axis(similarities, best, axis=1)
+                candidates = np.take_along_axis(candidates, best, axis=1)
+            top_similarities, top = similarities, candidates
+
+        # by descending similarity, ties by control index
+        order = np.lexsort((top, -top_similarities), axis=-1)
+        top = np.take_along_axis(top, order, axis=1)
+        matching_counts = (np.take_along_axis(top_similarities, order, axis=1) > SIMILARITY_THRESHOLD).sum(axis=1)
+
+        for i in range(schizos_block.shape[0]):
+            yield start+i, top[i], matching_counts[i]
+
+
+def get_similar_controls(schizo_ind, sorted_similarities, matching_controls_num, writer):
     if matching_controls_num < 5:
-        print("Skipping {} controls for user {}".format(matching_controls_num, schizos_dict[schizo_ind][0]))
+        print("Skipping {} controls for user {}".format(matching_controls_num, schizos_group[schizo_ind][0]))
 
-    sorted_controls_posts = [controls_dict[ind] for ind in sorted_similarities]
-    schizo_user = schizos_dict[schizo_ind]
-    insert_user_to_output_json(schizo_user[0], 'schizophrenia', schizo_user[1], output_dataset)
-    [insert_user_to_output_json(control_user[0], 'control', control_user[1], output_dataset)
-     for control_user in sorted_controls_posts]
+    sorted_controls_posts = [controls_group[ind] for ind in sorted_similarities]
+    writer.write_group(schizos_group[schizo_ind], sorted_controls_posts)
 
 
 if __name__ == "__main__":
@@ -105,33 +376,91 @@ if __name__ == "__main__":
     parser.add_argument('--controls', type=str, nargs='+', required=True, help='Controls Twitter history file')
     parser.add_argument('--n_processes', type=int, default=1, help='How many processes to use for runtime speedup')
     parser.add_argument('--matching_controls_cnt', type=int, default=7, help='How many controls to match each schizo')
+    parser.add_argument('--preprocess_cache', type=str, default='preprocess_cache.sqlite',
+                        help='Optional cache of preprocessed posts reused across runs, pass an empty string to disable')
+    parser.add_argument('--preprocess_cache_size', type=int, default=5000000,
+                        help='Maximum number of posts kept in the preprocessing cache')
+    parser.add_argument('--matcher', type=str, default='exact', choices=['exact', 'lsh'],
+                        help='Exact cosine similarity search or approximate search using an LSH index')
+    parser.add_argument('--lsh_tables', type=int, default=16, help='Number of LSH hash tables')
+    parser.add_argument('--lsh_bits', type=int, default=12, help='Number of hyperplanes per LSH hash table')
+    parser.add_argument('--ann_report', action='store_true', default=False,
+                        help='Only report the LSH recall compared to the exact search, without writing the dataset')
+    parser.add_argument('--tfidf_dir', type=str, default=None,
+                        help='Optional directory to persist the TF-IDF model and matrices in')
+    parser.add_argument('--tfidf_mode', type=str, default='refit', choices=['refit', 'incremental'],
+                        help='Refit the TF-IDF model on all users, or only vectorize users missing from tfidf_dir')
+    parser.add_argument('--vectorizer', type=str, default='tfidf', choices=['tfidf', 'hashing'],
+                        help='Fit a TF-IDF vocabulary in memory, or stream the users through a hashing vectorizer '
+                             'writing the matrices to tfidf_dir, for groups larger than memory')
+    parser.add_argument('--hashing_features', type=int, default=HASHING_FEATURES,
+                        help='Number of hashed features of the hashing vectorizer')
+    parser.add_argument('--output', type=str, default='tssd', help='Optional output file')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='Continue a half-finished output file instead of overwriting it')
     args = parser.parse_args()
+    if args.vectorizer == 'hashing' and not args.tfidf_dir:
+        parser.error('--vectorizer hashing requires --tfidf_dir')
+    if args.vectorizer == 'hashing' and args.tfidf_mode == 'incremental':
+        parser.error('--vectorizer hashing always vectorizes all users, --tfidf_mode incremental is not supported')
 
     n_processes = args.n_processes
     controls_history_file = args.controls
     schizos_history_file = args.schizos
 
-    all_hist = []
-    manager = Manager()
-    controls_dict = manager.dict()
-    schizos_dict = manager.dict()
+    cache = PreprocessCache(args.preprocess_cache, args.preprocess_cache_size) if args.preprocess_cache else None
+    with Pool(processes=n_processes, initializer=init, initargs=(args.preprocess_cache,)) as pool:
+        if args.vectorizer == 'hashing':
+            ((controls_group, tfidf_controls), (schizos_group, tfidf_schizos)), weights = vectorize_streaming(
+                [('controls', controls_history_file), ('schizos', schizos_history_file)],
+                pool, args.tfidf_dir, cache, args.hashing_features)
+        else:
+            controls_group, controls_hist = read_group_posts(controls_history_file, pool, cache)
+            schizos_group, schizos_hist = read_group_posts(schizos_history_file, pool, cache)
+    if cache is not None:
+        cache.evict()
+        cache.close()
 
-    controls_hist = read_group_posts(controls_history_file, controls_dict)
-    schizos_hist = read_group_posts(schizos_history_file, schizos_dict)
-    all_hist.extend(controls_hist)
-    all_hist.extend(schizos_hist)
+    if args.vectorizer == 'tfidf':
+        weights = None
+        tfidf_controls, tfidf_schizos = vectorize(controls_group, controls_hist, schizos_group, schizos_hist,
+                                                  args.tfidf_dir, args.tfidf_mode)
 
-    controls_cnt = len(controls_hist)
-    tfidf = TfidfVectorizer().fit_transform(all_hist)
-    tfidf_controls = tfidf[0:controls_cnt]
-    tfidf_schizos = tfidf[controls_cnt:]
+    writer = None
+    if not args.ann_report:
+        writer = DatasetWriter(args.output, args.resume)
+        # skip the schizos matched by a previous run
+        if args.vectorizer == 'hashing':
+            todo = [i for i, user_id in enumerate(schizos_group.ids) if user_id not in writer.done_schizos]
+            schizos_group = schizos_group.select(todo)
+        else:
+            todo = [i for i, (user_id, _) in enumerate(schizos_group) if user_id not in writer.done_schizos]
+            schizos_group = [schizos_group[i] for i in todo]
+        tfidf_schizos = tfidf_schizos[todo]
 
-    output_dataset = []
-    for schizo_ind, schizo_vec in tqdm(enumerate(tfidf_schizos), total=tfidf_schizos.shape[0],
-                                       desc='Finding similar controls for schizophrenics'):
-        get_similar_controls(schizo_ind, schizo_vec)
+    if args.matcher == 'lsh' or args.ann_report:
+        start_time = time.time()
+        # the LSH index is held in memory, so are the weighted matrices
+        lsh_index = LshIndex(row_block(tfidf_controls, 0, tfidf_controls.shape[0], weights),
+                             args.lsh_tables, args.lsh_bits)
+        print('Built LSH index in {:.1f} seconds'.format(time.time() - start_time))
+        similar_controls = lsh_index.top_k_similar(row_block(tfidf_schizos, 0, tfidf_schizos.shape[0], weights),
+                                                   args.matching_controls_cnt, SIMILARITY_THRESHOLD)
+    else:
+        similar_controls = top_k_similar(tfidf_schizos, tfidf_controls, args.matching_controls_cnt, weights)
 
-    with open("tssd", 'w', encoding='utf-8') as out:
-        for row in output_dataset:
-            json.dump(row, out)
-            out.write("\n")
+    if args.ann_report:
+        start_time = time.time()
+        ann_results = list(similar_controls)
+        ann_time = time.time() - start_time
+        start_time = time.time()
+        exact_results = list(top_k_similar(tfidf_schizos, tfidf_controls, args.matching_controls_cnt, weights))
+        exact_time = time.time() - start_time
+        report = recall_report(exact_results, ann_results, args.matching_controls_cnt)
+        report.update({'lsh_seconds': ann_time, 'exact_seconds': exact_time})
+        print(json.dumps(report, indent=2))
+    else:
+        for schizo_ind, sorted_similarities, matching_controls_num in tqdm(
+                similar_controls, total=tfidf_schizos.shape[0], desc='Finding similar controls for schizophrenics'):
+            get_similar_controls(schizo_ind, sorted_similarities, matching_controls_num, writer)
+        writer.close()
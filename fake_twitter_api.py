@@ -0,0 +1,138 @@
+import datetime
+import random
+import threading
+import time
+
+import tweepy
+
+from rate_limiter import RATE_LIMIT_WINDOW
+
+USER_TIMELINE = '/statuses/user_timeline'
+USERS_LOOKUP = '/users/lookup'
+# rate limit status resource of each endpoint
+ENDPOINTS = {USER_TIMELINE: 'statuses', USERS_LOOKUP: 'users'}
+
+
+class FakeStatus:
+    def __init__(self, status_id, full_text, lang, created_at, hashtags):
+        self.id = status_id
+        self.full_text = full_text
+        self.lang = lang
+        self.created_at = created_at
+        self.entities = {'hashtags': [{'text': hashtag} for hashtag in hashtags]}
+
+
+class FakeUser:
+    def __init__(self, user_id, protected, statuses_count, lang=None):
+        self.id_str = user_id
+        self.id = int(user_id)
+        self.protected = protected
+        self.statuses_count = statuses_count
+        self.lang = lang
+
+
+class FakeTwitterAPI:
+    """
+    Local stand-in for tweepy.API, used to exercise UserTweetFetcher without network access.
+    It serves generated timelines and user profiles, and enforces per endpoint rate limits like the real api.
+    """
+    def __init__(self, timelines, limit=900, window=RATE_LIMIT_WINDOW, latency=0.0, users=None):
+        """
+        :param timelines: dictionary of user id to list of FakeStatus, newest first
+        :param limit: requests allowed per window, for each endpoint
+        :param window: rate limit window in seconds
+        :param latency: seconds each request takes
+        :param users: optional dictionary of user id to FakeUser, by default users are public
+        and their status count is their timeline's length
+        """
+        self._timelines = timelines
+        self._users = users if users is not None else {
+            user_id: FakeUser(user_id, False, len(statuses)) for user_id, statuses in timelines.items()}
+        self._limit = limit
+        self._window = window
+        self._latency = latency
+        self._remaining = {endpoint: limit for endpoint in ENDPOINTS}
+        self._reset = {endpoint: time.time() + window for endpoint in ENDPOINTS}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.rate_limited_calls = 0
+        self.lookup_calls = 0
+
+    @classmethod
+    def generate(cls, n_users, tweets_per_user=300, english_ratio=0.9, protected_ratio=0.0, seed=0, **kwargs):
+        """
+        Create an api serving random timelines for users '0'..'n_users-1'.
+        Protected users' timelines can't be read, and every user's status count also includes
+        replies and retweets which their timeline excludes.
+        """
+        rnd = random.Random(seed)
+        # separate generator, so the timelines are the same whatever the profiles
+        profiles_rnd = random.Random(seed + 1)
+        words = ['schizophrenia', 'coffee', 'today', 'music', 'game', 'love', 'work', 'sleep', 'friends', 'news']
+        now = datetime.datetime(2019, 9, 1)
+        timelines = {}
+        users = {}
+        status_id = 10 ** 12
+        for user_id in range(n_users):
+            statuses = []
+            for i in range(rnd.randint(0, tweets_per_user)):
+                status_id -= rnd.randint(1, 1000)
+                text = ' '.join(rnd.choice(words) for _ in range(rnd.randint(3, 20)))
+                lang = 'en' if rnd.random() < english_ratio else 'es'
+                hashtags = [rnd.choice(words)] if rnd.random() < 0.2 else []
+                statuses.append(FakeStatus(status_id, text, lang, now - datetime.timedelta(hours=i), hashtags))
+            timelines[str(user_id)] = statuses
+            users[str(user_id)] = FakeUser(str(user_id), profiles_rnd.random() < protected_ratio,
+                                           len(statuses) + profiles_rnd.randint(0, tweets_per_user // 4))
+        return cls(timelines, users=users, **kwargs)
+
+    def _take_request(self, endpoint):
+        with self._lock:
+            now = time.time()
+            if now >= self._reset[endpoint]:
+                self._remaining[endpoint] = self._limit
+                self._reset[endpoint] = now + self._window
+            if endpoint == USER_TIMELINE:
+                self.calls += 1
+            else:
+                self.lookup_calls += 1
+            if self._remaining[endpoint] <= 0:
+                self.rate_limited_calls += 1
+                raise tweepy.RateLimitError('Rate limit exceeded')
+            self._remaining[endpoint] -= 1
+
+    def user_timeline(self, user_id, count=20, max_id=None, **kwargs):
+        self._take_request(USER_TIMELINE)
+        if self._latency:
+            time.sleep(self._latency)
+        if user_id not in self._timelines:
+            raise tweepy.TweepError('Sorry, that page does not exist.')
+        if self._users[user_id].protected:
+            raise tweepy.TweepError('Not authorized.')
+        statuses = self._timelines[user_id]
+        if max_id:
+            statuses = [status for status in statuses if status.id <= max_id]
+        return statuses[:int(count)]
+
+    def lookup_users(self, user_ids, **kwargs):
+        """
+        :return: profiles of the existing users among up to 100 user ids
+        """
+        self._take_request(USERS_LOOKUP)
+        if self._latency:
+            time.sleep(self._latency)
+        users = [self._users[user_id] for user_id in user_ids[:100] if user_id in self._users]
+        if not users:
+            raise tweepy.TweepError('No user matches for specified terms.', api_code=17)
+        return users
+
+    def rate_limit_status(self):
+        with self._lock:
+            resources = {}
+            for endpoint, resource in ENDPOINTS.items():
+                resources.setdefault(resource, {})[endpoint] = {
+                    'limit': self._limit,
+                    'remaining': self._remaining[endpoint],
+                    'reset': self._reset[endpoint]
+                }
+            return {'resources': resources}
@@ -0,0 +1,84 @@
+"""
+Shared JSON decoding for the tweet pipeline.
+Uses orjson for full decoding and pysimdjson for field extraction when they are installed,
+otherwise falls back to the standard json module.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson
+    _simdjson_parser = simdjson.Parser()
+except ImportError:
+    simdjson = None
+    _simdjson_parser = None
+
+# every backend raises a ValueError subclass on malformed input
+DECODE_ERRORS = (ValueError,)
+
+
+def backend_name():
+    return 'orjson' if orjson else 'json'
+
+
+def loads(data):
+    """
+    Decode a JSON document.
+    :param data: str or bytes
+    :return: decoded object
+    """
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def load_file(path):
+    with open(path, 'rb') as f:
+        return loads(f.read())
+
+
+def has_key(line, key):
+    """
+    Check the raw line for an object key without decoding it.
+    Assumes compact JSON as produced by the Twitter API, so a False result is not conclusive.
+    """
+    return '"{}":'.format(key) in line
+
+
+def extract(line, *paths):
+    """
+    Extract only the given fields from a JSON line.
+    With simdjson the document is parsed lazily and only the requested fields are materialized.
+    :param line: str or bytes
+    :param paths: tuples of keys, e.g. ('user', 'id_str')
+    :return: tuple of values, one per path
+    :raises KeyError: if a field is missing
+    """
+    if _simdjson_parser:
+        if isinstance(line, str):
+            line = line.encode('utf-8')
+        document = _simdjson_parser.parse(line)
+        values = []
+        for path in paths:
+            value = document
+            for key in path:
+                value = value[key]
+            if isinstance(value, simdjson.Object):
+                value = value.as_dict()
+            elif isinstance(value, simdjson.Array):
+                value = value.as_list()
+            values.append(value)
+        return tuple(values)
+
+    document = loads(line)
+    values = []
+    for path in paths:
+        value = document
+        for key in path:
+            value = value[key]
+        values.append(value)
+    return tuple(values)
@@ -0,0 +1,141 @@
+import json
+import os
+import re
+from collections import Counter
+
+import fast_json
+from columnar_history import ColumnarHistory
+from user_store import UserStore
+
+# hashtags containing any of these are mental health related and excluded from the control track list
+EXCLUDED_SUBSTRINGS = ['psych', 'schizo', 'suic', 'ptsd', 'bipolar', 'mental', 'anxiet', 'depress', 'bpd', 'therapy',
+                       'sicknotweak', 'thestigma', 'ocd', 'meds', 'medicat', 'trauma', 'mania']
+EXCLUDED_PATTERN = re.compile('|'.join(re.escape(substring) for substring in EXCLUDED_SUBSTRINGS))
+
+# hashtags in a post text, Twitter doesn't link all numeric hashtags
+HASHTAG_PATTERN = re.compile(r'(?<!\w)#(\w*[^\W\d]\w*)')
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# version of the saved index, an index saved by another version is rebuilt
+INDEX_VERSION = 2
+
+
+def iter_users(path, skip=()):
+    """
+    Stream the users of the fetcher's storage: a UserStore jsonl file, a columnar history directory
+    or a legacy json file.
+    :param skip: optional user ids which are not read
+    :return: generator of (user_id, user_data)
+    """
+    if ColumnarHistory.is_columnar(path):
+        history = ColumnarHistory(path)
+        for i, user_id in enumerate(history.user_ids()):
+            if user_id not in skip:
+                yield user_id, {'posts': history.posts(i), 'hashtags': history.hashtags(i)}
+    elif path.endswith('.jsonl'):
+        store = UserStore(path, readonly=True)
+        yield from store.items(skip)
+        store.close()
+    else:
+        for user_id, user_data in fast_json.load_file(path).items():
+            if user_id not in skip:
+                yield user_id, user_data
+
+
+class HashtagIndex:
+    """
+    Incremental hashtag counts of the fetched users.
+    Every hashtag occurrence is counted once per lowercased tag, and the exclusion filter runs on the unique tags
+    at query time. The hashtags are found in the post texts, which have creation times unlike the users' hashtag
+    entities, and are counted per day for top hashtags in a time window and in total, so a hashtag counts the same
+    with or without a window.
+    The index is saved with the ids of its users, so updating it only reads the users fetched since.
+    """
+    def __init__(self, path=None):
+        self._path = path
+        self._users = set()
+        self._counts = Counter()
+        self._daily = {}
+        if path and os.path.isfile(path):
+            with open(path, encoding='utf-8') as f:
+                index = json.load(f)
+            if index.get('version') != INDEX_VERSION:
+                print('Rebuilding the hashtag index {} saved by another version'.format(path))
+                return
+            self._users = set(index['users'])
+            self._counts = Counter(index['hashtags'])
+            self._daily = {int(day): Counter(counts) for day, counts in index['daily'].items()}
+
+    def __len__(self):
+        return len(self._users)
+
+    def add_user(self, user_id, user_data):
+        """
+        :return: False if the user is already indexed
+        """
+        if user_id in self._users:
+            return False
+        self._users.add(user_id)
+        for created_at, text in user_data['posts']:
+            if '#' in text:
+                hashtags = HASHTAG_PATTERN.findall(text.lower())
+                self._counts.update(hashtags)
+                self._daily.setdefault(int(created_at // SECONDS_PER_DAY), Counter()).update(hashtags)
+        return True
+
+    def update(self, path):
+        """
+        Index the users of the fetcher's storage which aren't indexed yet.
+        :return: number of added users
+        """
+        added = 0
+        for user_id, user_data in iter_users(path, self._users):
+            added += self.add_user(user_id, user_data)
+        return added
+
+    def _window_counts(self, since=None, until=None):
+        if since is None and until is None:
+            return self._counts
+        first_day = since // SECONDS_PER_DAY if since is not None else float('-inf')
+        last_day = until // SECONDS_PER_DAY if until is not None else float('inf')
+        counts = Counter()
+        for day in sorted(self._daily):
+            if first_day <= day <= last_day:
+                counts.update(self._daily[day])
+        return counts
+
+    def total(self, since=None, until=None):
+        """
+        :param since: optional unix timestamp, only count posts created since its day
+        :param until: optional unix timestamp, only count posts created until the end of its day
+        :return: number of hashtag occurrences
+        """
+        return sum(self._window_counts(since, until).values())
+
+    def most_common(self, n=200, since=None, until=None):
+        """
+        :param n: number of hashtags
+        :param since: optional unix timestamp, only count posts created since its day
+        :param until: optional unix timestamp, only count posts created until the end of its day
+        :return: list of the n most common (hashtag, count) which aren't excluded
+        """
+        counts = self._window_counts(since, until)
+        top = []
+        for hashtag, count in counts.most_common():
+            if len(top) == n:
+                break
+            if not EXCLUDED_PATTERN.search(hashtag):
+                top.append((hashtag, count))
+        return top
+
+    def save(self):
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'version': INDEX_VERSION,
+                'users': sorted(self._users),
+                'hashtags': self._counts,
+                'daily': {str(day): counts for day, counts in self._daily.items()},
+            }, f)
+        os.replace(tmp_path, self._path)
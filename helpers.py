@@ -1,38 +1,33 @@
-import json
 import optparse
-from collections import Counter
+
+import fast_json
+from capture_segments import parse_date
+from hashtag_index import HashtagIndex
 
 
 def count_candidates_filtered_in(path='candidates_filtered_in.json'):
-    with open(path, encoding='utf-8') as f:
-        input_dict = json.load(f)
+    input_dict = fast_json.load_file(path)
     print("Count: {}".format(len(input_dict)))
 
 
-def get_candidates_unique_hashtags(path='candidates_timeline.json'):
-    with open(path, encoding='utf-8') as f:
-        input_dict = json.load(f)
-
-    unique_hashtags = []
-
-    for user_data in input_dict.values():
-        hashtags = user_data['hashtags']
-        [unique_hashtags.append(hashtag.lower()) for hashtag in hashtags]
-
-    filtered_hashtags = []
-    for h in unique_hashtags:
-        add = True
-        for f in ['psych', 'schizo', 'suic', 'ptsd', 'bipolar', 'mental', 'anxiet', 'depress', 'bpd', 'therapy',
-                  'sicknotweak', 'thestigma', 'ocd', 'meds', 'medicat', 'trauma', 'mania']:
-            if f in h:
-                add = False
-                break
-        if add:
-            filtered_hashtags.append(h)
-
-    hashtags_counter = Counter(filtered_hashtags).most_common()[:200]
-
-    print("Unique hashtags: {}/{}".format(len(hashtags_counter), len(unique_hashtags)))
+def get_candidates_unique_hashtags(path='candidates_timeline.json', index_path=None, top=200, since=None, until=None):
+    """
+    Print the most common hashtags of the fetched users which aren't mental health related,
+    used as the track list of the control users' filter stream.
+    :param path: the fetcher's UserStore jsonl file, a columnar history directory or a json history file
+    :param index_path: optional hashtag index file, which is updated with the new users of path and saved
+    :param since: optional unix timestamp, only count hashtags of posts created since
+    :param until: optional unix timestamp, only count hashtags of posts created until
+    """
+    index = HashtagIndex(index_path)
+    added = index.update(path)
+    if index_path:
+        print('Indexed {} new users, {} in total'.format(added, len(index)))
+        index.save()
+
+    hashtags_counter = index.most_common(top, since, until)
+
+    print("Unique hashtags: {}/{}".format(len(hashtags_counter), index.total(since, until)))
     print(','.join([m[0] for m in hashtags_counter]))
 
 
@@ -42,9 +37,15 @@ if __name__ == '__main__':
     parser.add_option('--path_c', action="store", default='candidates_filtered_in.json')
     parser.add_option('-u', '--unique_hashtags', action="store_true", default=False, dest='u')
     parser.add_option('--path_u', action="store", default='candidates_timeline.json')
+    parser.add_option('--index_u', action="store", default=None)
+    parser.add_option('--top_u', action="store", type='int', default=200)
+    parser.add_option('--since_u', action="store", default=None)
+    parser.add_option('--until_u', action="store", default=None)
     options, remainder = parser.parse_args()
 
     if options.c:
         count_candidates_filtered_in(options.path_c)
     if options.u:
-        get_candidates_unique_hashtags(options.path_u)
+        get_candidates_unique_hashtags(options.path_u, options.index_u, options.top_u,
+                                       parse_date(options.since_u) if options.since_u else None,
+                                       parse_date(options.until_u) if options.until_u else None)
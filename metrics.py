@@ -0,0 +1,158 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300]
+
+# minimal seconds between periodic exports of long running collectors
+EXPORT_INTERVAL = 60
+
+
+def escape_label_value(value):
+    """
+    :return: label value escaped for the Prometheus text format, where backslashes, quotes and newlines are escaped
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    """
+    Thread safe registry of counters and latency histograms, exported as a Prometheus textfile or json.
+    Metrics are identified by a name and optional labels, e.g. inc('lines_dropped_total', filter='retweet').
+    Registries of worker processes can be sent to the parent with snapshot and combined there with merge.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._last_export = 0
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = {'buckets': [0] * len(LATENCY_BUCKETS), 'count': 0, 'sum': 0.0}
+            histogram = self._histograms[key]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+                    break
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+
+    def counter(self, name, **labels):
+        return self._counters.get(self._key(name, labels), 0)
+
+    def snapshot(self, reset=True):
+        """
+        :return: picklable copy of the metrics, optionally resetting them
+        """
+        with self._lock:
+            snapshot = (dict(self._counters),
+                        {key: {'buckets': list(h['buckets']), 'count': h['count'], 'sum': h['sum']}
+                         for key, h in self._histograms.items()})
+            if reset:
+                self._counters = {}
+                self._histograms = {}
+        return snapshot
+
+    def merge(self, snapshot):
+        counters, histograms = snapshot
+        with self._lock:
+            for key, value in counters.items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, other in histograms.items():
+                histogram = self._histograms.setdefault(
+                    key, {'buckets': [0] * len(LATENCY_BUCKETS), 'count': 0, 'sum': 0.0})
+                histogram['buckets'] = [a + b for a, b in zip(histogram['buckets'], other['buckets'])]
+                histogram['count'] += other['count']
+                histogram['sum'] += other['sum']
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(name, escape_label_value(value)) for name, value in labels) + '}'
+
+    def to_prometheus(self):
+        lines = []
+        counters, histograms = self.snapshot(reset=False)
+        # a TYPE line before the samples of each metric family, which are together since they're sorted by name
+        previous_name = None
+        for (name, labels), value in sorted(counters.items()):
+            if name != previous_name:
+                lines.append('# TYPE {} counter'.format(name))
+                previous_name = name
+            lines.append('{}{} {}'.format(name, self._labels(labels), value))
+        for (name, labels), histogram in sorted(histograms.items()):
+            if name != previous_name:
+                lines.append('# TYPE {} histogram'.format(name))
+                previous_name = name
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, histogram['buckets']):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, self._labels(labels, [('le', bound)]), cumulative))
+            lines.append('{}_bucket{} {}'.format(name, self._labels(labels, [('le', '+Inf')]), histogram['count']))
+            lines.append('{}_sum{} {}'.format(name, self._labels(labels), histogram['sum']))
+            lines.append('{}_count{} {}'.format(name, self._labels(labels), histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self):
+        counters, histograms = self.snapshot(reset=False)
+        return {
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                         for (name, labels), value in sorted(counters.items())],
+            'histograms': [dict(name=name, labels=dict(labels), le=LATENCY_BUCKETS, **histogram)
+                           for (name, labels), histogram in sorted(histograms.items())],
+        }
+
+    def export(self, path):
+        """
+        Write the metrics to path, as json if it ends with .json and in the Prometheus textfile format otherwise.
+        The file is replaced atomically so collectors never read a partial export.
+        """
+        tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(tmp_path, 'w') as out:
+            if path.endswith('.json'):
+                json.dump(self.to_json(), out, indent=2)
+            else:
+                out.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    def maybe_export(self, path, interval=EXPORT_INTERVAL):
+        """
+        Export to path if the last export is older than interval seconds, for progress of long running collectors.
+        """
+        if not path:
+            return
+        with self._lock:
+            now = time.time()
+            if now - self._last_export < interval:
+                return
+            self._last_export = now
+        self.export(path)
+
+
+# process wide registry
+registry = Metrics()
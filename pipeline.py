@@ -0,0 +1,378 @@
+import argparse
+import ast
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from capture_segments import ACTIVE_SEGMENT, CaptureSegments
+from preprocess_cache import PATTERN_FILES
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# fingerprints of the built stages and content digests of the hashed files, kept in the work directory
+STATE_FILE = 'pipeline_state.json'
+
+# bytes read at once when hashing a file
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def module_closure(script):
+    """
+    :param script: path of a script in the repository
+    :return: sorted paths of the script and the repository modules it imports, directly or not
+    """
+    paths = set()
+    todo = [os.path.join(REPO_DIR, script)]
+    while todo:
+        path = todo.pop()
+        if path in paths:
+            continue
+        paths.add(path)
+        with open(path, encoding='utf-8') as f:
+            tree = ast.parse(f.read(), path)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                module_path = os.path.join(REPO_DIR, name.split('.')[0] + '.py')
+                if os.path.isfile(module_path):
+                    todo.append(module_path)
+    return sorted(paths)
+
+
+class FileHasher:
+    """
+    Content digests of files and directories.
+    A file's digest is cached with its size and modification time, so large captures are only read again
+    when they change. A capture segments directory is represented by its manifest, since its active segment
+    is still being written and isn't read by the pipeline. Active segments are skipped in other directories too,
+    e.g. a capture directory whose manifest wasn't written yet.
+    """
+    def __init__(self, cache):
+        self._cache = cache
+
+    def _file_digest(self, path):
+        stat = os.stat(path)
+        cached = self._cache.get(path)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+        self._cache[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def digest(self, path):
+        """
+        :return: hex digest of a file or directory's content, None if it doesn't exist
+        """
+        if os.path.isfile(path):
+            return self._file_digest(path)
+        if not os.path.isdir(path):
+            return None
+        if CaptureSegments.is_segment_directory(path):
+            return self._file_digest(os.path.join(path, 'manifest.json'))
+        digest = hashlib.sha256()
+        for directory, dir_names, file_names in sorted(os.walk(path)):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                if file_name == ACTIVE_SEGMENT:
+                    continue
+                file_path = os.path.join(directory, file_name)
+                digest.update(os.path.relpath(file_path, path).encode('utf-8'))
+                digest.update(self._file_digest(file_path).encode())
+        return digest.hexdigest()
+
+
+class Stage:
+    """
+    A script run of the pipeline, which reads its input files and writes its output files.
+    :param name: stage name
+    :param script: script in the repository
+    :param args: arguments of the script, part of the stage's fingerprint
+    :param inputs: files and directories the stage reads, the outputs of other stages or external inputs
+    :param outputs: files the stage writes
+    :param config: config files the stage's code reads
+    :param run_args: arguments which don't change the outputs, such as the number of processes
+    :param rebuild_args: arguments added when the code, config or arguments changed since the last build
+                         or an output is missing, to rebuild incremental outputs from scratch
+    :param stdout: optional output file the script's stdout is written to
+    """
+    def __init__(self, name, script, args, inputs, outputs, config=(), run_args=(), rebuild_args=(), stdout=None):
+        self.name = name
+        self.script = script
+        self.args = list(args)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs) + ([stdout] if stdout else [])
+        self.config = [os.path.join(REPO_DIR, path) for path in config]
+        self.run_args = list(run_args)
+        self.rebuild_args = list(rebuild_args)
+        self.stdout = stdout
+
+    def command(self, rebuild=False):
+        return ([sys.executable, os.path.join(REPO_DIR, self.script)] + self.args + self.run_args +
+                (self.rebuild_args if rebuild else []))
+
+    def code_fingerprint(self, hasher):
+        """
+        :return: hex digest of the stage's code, config files and arguments
+        """
+        fingerprint = hashlib.sha256(json.dumps(self.args).encode('utf-8'))
+        for path in module_closure(self.script) + self.config:
+            fingerprint.update(os.path.relpath(path, REPO_DIR).encode('utf-8'))
+            fingerprint.update(str(hasher.digest(path)).encode())
+        return fingerprint.hexdigest()
+
+    def input_digests(self, hasher):
+        return {path: hasher.digest(path) for path in self.inputs}
+
+
+class Pipeline:
+    """
+    Dependency graph of stages, where a stage depends on the stages writing its inputs.
+    A stage is rebuilt when it was never built, one of its outputs is missing, or its code, config, arguments
+    or input contents changed since its last successful build. Stages are checked once the stages they depend on
+    are done, so a rebuilt stage whose outputs didn't change doesn't rebuild the stages after it.
+    Independent stages run in parallel.
+    """
+    def __init__(self, stages, work_dir):
+        self._stages = {stage.name: stage for stage in stages}
+        self._state_path = os.path.join(work_dir, STATE_FILE)
+        self._log_dir = os.path.join(work_dir, 'logs')
+        self._state = {'stages': {}, 'files': {}}
+        if os.path.isfile(self._state_path):
+            with open(self._state_path, encoding='utf-8') as f:
+                self._state = json.load(f)
+        self._hasher = FileHasher(self._state['files'])
+
+        producers = {output: stage.name for stage in stages for output in stage.outputs}
+        self._produced = set(producers)
+        self._deps = {stage.name: sorted({producers[path] for path in stage.inputs if path in producers})
+                      for stage in stages}
+        self._order = self._topological_order()
+
+    def _topological_order(self):
+        order = []
+        visiting = set()
+
+        def visit(name):
+            if name in order:
+                return
+            if name in visiting:
+                raise ValueError('Stage {} depends on itself'.format(name))
+            visiting.add(name)
+            for dep in self._deps[name]:
+                visit(dep)
+            order.append(name)
+
+        for name in self._stages:
+            visit(name)
+        return order
+
+    def _save_state(self):
+        tmp_path = self._state_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._state, f, indent=1)
+        os.replace(tmp_path, self._state_path)
+
+    def stale_reasons(self, name, force=()):
+        """
+        :return: tuple of (list of reasons to rebuild the stage, empty if it's up to date,
+                 whether to rebuild it from scratch, its fingerprint to record once built)
+        """
+        stage = self._stages[name]
+        fingerprint = {'code': stage.code_fingerprint(self._hasher), 'inputs': stage.input_digests(self._hasher)}
+        built = self._state['stages'].get(name)
+        reasons = []
+        if name in force or 'all' in force:
+            reasons.append('forced')
+        # the outputs of the stages before are only missing until they're built
+        missing_inputs = [path for path, digest in fingerprint['inputs'].items()
+                          if digest is None and path not in self._produced]
+        if missing_inputs:
+            reasons.append('missing inputs {}'.format(', '.join(missing_inputs)))
+        if built is None:
+            reasons.append('never built')
+            return reasons, True, fingerprint
+
+        missing = [path for path in stage.outputs if not os.path.exists(path)]
+        if missing:
+            reasons.append('missing outputs {}'.format(', '.join(missing)))
+        code_changed = built['code'] != fingerprint['code']
+        if code_changed:
+            reasons.append('code, config or arguments changed')
+        changed = [path for path, digest in fingerprint['inputs'].items()
+                   if digest is not None and built['inputs'].get(path) != digest]
+        if changed:
+            reasons.append('changed inputs {}'.format(', '.join(changed)))
+        return reasons, code_changed or bool(missing) or name in force or 'all' in force, fingerprint
+
+    def dry_run(self, force=()):
+        """
+        Print what would be rebuilt, without running anything or writing the state file.
+        The stages after a stage to rebuild are listed as rebuilt as well, since its outputs may change.
+        """
+        stale = set()
+        for name in self._order:
+            reasons, rebuild, _ = self.stale_reasons(name, force)
+            reasons += ['stage {} is rebuilt'.format(dep) for dep in self._deps[name] if dep in stale]
+            if reasons:
+                stale.add(name)
+                print('{}: rebuild, {}'.format(name, '; '.join(reasons)))
+                print('    ' + subprocess.list2cmdline(self._stages[name].command(rebuild)))
+            else:
+                print('{}: up to date'.format(name))
+
+    def _run_stage(self, stage, rebuild):
+        os.makedirs(self._log_dir, exist_ok=True)
+        log_path = os.path.join(self._log_dir, '{}.log'.format(stage.name))
+        start_time = time.time()
+        with open(log_path, 'w', encoding='utf-8') as log:
+            if stage.stdout:
+                tmp_path = stage.stdout + '.tmp'
+                with open(tmp_path, 'w', encoding='utf-8') as out:
+                    returncode = subprocess.call(stage.command(rebuild), stdout=out, stderr=log, cwd=REPO_DIR)
+                if returncode == 0:
+                    os.replace(tmp_path, stage.stdout)
+            else:
+                returncode = subprocess.call(stage.command(rebuild), stdout=log, stderr=subprocess.STDOUT,
+                                             cwd=REPO_DIR)
+        return returncode, time.time() - start_time, log_path
+
+    def run(self, n_parallel=2, force=()):
+        """
+        Build the stale stages, running independent stages in parallel.
+        :return: True if every stage is up to date
+        """
+        done = set()
+        failed = set()
+        running = {}
+        todo = list(self._order)
+        with ThreadPoolExecutor(max_workers=n_parallel) as executor:
+            while todo or running:
+                for name in list(todo):
+                    if any(dep in failed for dep in self._deps[name]):
+                        print('{}: not run, a stage it depends on failed'.format(name))
+                        todo.remove(name)
+                        failed.add(name)
+                    elif all(dep in done for dep in self._deps[name]):
+                        todo.remove(name)
+                        reasons, rebuild, fingerprint = self.stale_reasons(name, force)
+                        if not reasons:
+                            print('{}: up to date'.format(name))
+                            done.add(name)
+                            continue
+                        print('{}: rebuilding, {}'.format(name, '; '.join(reasons)))
+                        future = executor.submit(self._run_stage, self._stages[name], rebuild)
+                        running[future] = (name, fingerprint)
+                if not running:
+                    continue
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name, fingerprint = running.pop(future)
+                    returncode, seconds, log_path = future.result()
+                    if returncode == 0:
+                        print('{}: built in {:.1f} seconds'.format(name, seconds))
+                        self._state['stages'][name] = dict(fingerprint, built_at=time.time())
+                        self._save_state()
+                        done.add(name)
+                    else:
+                        print('{}: failed with exit code {}, see {}'.format(name, returncode, log_path))
+                        failed.add(name)
+        self._save_state()
+        return not failed
+
+
+def build_stages(work_dir, schizo_capture, control_capture=None, high_precision=False, n_processes=1,
+                 oauth_config=None, matching_controls_cnt=7):
+    """
+    The TSSD stages:
+    schizo capture -> candidates -> schizo_history -> control_hashtags (the track list of the control capture)
+    control capture -> control_history, and both histories -> matching -> tssd.
+    The stages after the control capture are only included when it's given.
+    """
+    def path(name):
+        return os.path.join(work_dir, name)
+
+    oauth_config = oauth_config or os.path.join(REPO_DIR, 'config', 'oauth_config')
+    stages = [
+        Stage('candidates', 'read_twitter_text.py',
+              ['--input'] + schizo_capture + ['--output', path('candidates.json'), '--log', path('candidates.txt'),
+                                              '--checkpoint', path('candidates_checkpoint.json'),
+                                              '--dedup', path('candidates_seen.bloom')] +
+              (['--high_precision'] if high_precision else []),
+              inputs=schizo_capture, outputs=[path('candidates.json')], config=PATTERN_FILES,
+              run_args=['--n_processes', str(n_processes)], rebuild_args=['--from_start']),
+        Stage('schizo_history', 'read_users_history.py',
+              ['--users_paths', path('candidates.json'), '--save_path', path('candidates_timeline.json'),
+               '--store_path', path('candidates_timeline.jsonl'), '--skip_cache', path('skipped_users.jsonl'),
+               '--oauth_config', oauth_config],
+              inputs=[path('candidates.json')], outputs=[path('candidates_timeline.json')]),
+        Stage('control_hashtags', 'helpers.py', ['-u', '--path_u', path('candidates_timeline.json')],
+              inputs=[path('candidates_timeline.json')], outputs=[], stdout=path('control_hashtags.txt')),
+    ]
+    if control_capture:
+        stages += [
+            Stage('control_history', 'read_users_history.py',
+                  ['--users_paths'] + control_capture + ['--raw_data', '--save_path', path('controls_timeline.json'),
+                                                         '--store_path', path('controls_timeline.jsonl'),
+                                                         '--skip_cache', path('controls_skipped_users.jsonl'),
+                                                         '--oauth_config', oauth_config],
+                  inputs=control_capture, outputs=[path('controls_timeline.json')]),
+            Stage('matching', 'extract_matching_controls.py',
+                  ['--schizos', path('candidates_timeline.json'), '--controls', path('controls_timeline.json'),
+                   '--matching_controls_cnt', str(matching_controls_cnt), '--output', path('tssd')],
+                  inputs=[path('candidates_timeline.json'), path('controls_timeline.json')], outputs=[path('tssd')],
+                  config=PATTERN_FILES,
+                  run_args=['--n_processes', str(n_processes),
+                            '--preprocess_cache', path('preprocess_cache.sqlite')]),
+        ]
+    return stages
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prefix_chars='--')
+    parser.add_argument('--schizo_capture', type=str, nargs='+', required=True,
+                        help='Capture files or segment directories of the schizophrenia filter stream')
+    parser.add_argument('--control_capture', type=str, nargs='+', default=None,
+                        help='Optional capture files or segment directories of the control filter stream, '
+                             'captured with the track list in control_hashtags.txt')
+    parser.add_argument('--work_dir', type=str, default='.', help='Directory of the artifacts and pipeline state')
+    parser.add_argument('--dry_run', action='store_true', default=False,
+                        help='Only print which stages would be rebuilt and why, with their commands')
+    parser.add_argument('--force', type=str, nargs='+', default=(),
+                        help='Stages to rebuild from scratch even if they are up to date, or all')
+    parser.add_argument('--n_parallel', type=int, default=2, help='How many independent stages to run at once')
+    parser.add_argument('-hp', '--high_precision', action='store_true', default=False,
+                        help='Search for candidates using SMHD high precision patterns')
+    parser.add_argument('--n_processes', type=int, default=1, help='How many processes each stage uses')
+    parser.add_argument('--oauth_config', type=str, default=None, help='Optional config file of the fetch stages')
+    parser.add_argument('--matching_controls_cnt', type=int, default=7, help='How many controls to match each schizo')
+    args = parser.parse_args()
+
+    work_dir = os.path.abspath(args.work_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    pipeline_stages = build_stages(
+        work_dir, [os.path.abspath(path) for path in args.schizo_capture],
+        [os.path.abspath(path) for path in args.control_capture] if args.control_capture else None,
+        args.high_precision, args.n_processes, os.path.abspath(args.oauth_config) if args.oauth_config else None,
+        args.matching_controls_cnt)
+    unknown = set(args.force) - {stage.name for stage in pipeline_stages} - {'all'}
+    if unknown:
+        parser.error('Unknown stages {}'.format(', '.join(sorted(unknown))))
+
+    pipeline = Pipeline(pipeline_stages, work_dir)
+    if args.dry_run:
+        pipeline.dry_run(args.force)
+    elif not pipeline.run(args.n_parallel, args.force):
+        sys.exit(1)
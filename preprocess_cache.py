@@ -0,0 +1,132 @@
+import hashlib
+import sqlite3
+
+# bump when Patterns.preprocess changes its output
+PREPROCESS_VERSION = 1
+PATTERN_FILES = ['config/positive_patterns.txt', 'config/negative_patterns.txt']
+
+
+def post_key(post):
+    return hashlib.blake2b(post.encode('utf-8'), digest_size=16).digest()
+
+
+def cache_version():
+    """
+    :return: fingerprint of everything the cached values depend on, the pattern files and the preprocessing code
+    """
+    version = hashlib.sha1(str(PREPROCESS_VERSION).encode())
+    for path in PATTERN_FILES:
+        with open(path, 'rb') as f:
+            version.update(f.read())
+    return version.hexdigest()
+
+
+class PreprocessCache:
+    """
+    Persistent cache of preprocessed posts keyed by the hash of the raw post.
+    Stores the Patterns.preprocess output together with its TermSentiment flags,
+    and is cleared automatically when the pattern files or the preprocessing version change.
+    Only the process owning the cache writes to it, readers open it with readonly=True.
+    """
+    def __init__(self, path, max_entries=5000000, readonly=False):
+        self._max_entries = max_entries
+        if readonly:
+            self._db = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+            return
+
+        self._db = sqlite3.connect(path)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        # a cache can afford losing the last commits on a power loss, so skip the fsync on every commit
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS posts '
+                         '(key BLOB PRIMARY KEY, text TEXT, positive INTEGER, negative INTEGER, last_used INTEGER)')
+
+        version = cache_version()
+        row = self._db.execute("SELECT value FROM meta WHERE name = 'version'").fetchone()
+        if not row or row[0] != version:
+            if row:
+                print('Pattern files changed, clearing the preprocessing cache')
+            self._db.execute('DELETE FROM posts')
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,))
+
+        # every run is a new generation, entries not used for the most generations are evicted first
+        row = self._db.execute("SELECT value FROM meta WHERE name = 'generation'").fetchone()
+        self._generation = int(row[0]) + 1 if row else 0
+        self._db.execute("INSERT OR REPLACE INTO meta VALUES ('generation', ?)", (str(self._generation),))
+        self._db.commit()
+
+    def get_many(self, keys):
+        """
+        :return: dictionary of key to (preprocessed text, positive flag, negative flag) for the cached keys
+        """
+        found = {}
+        keys = list(keys)
+        # stay below sqlite's limit of host parameters
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start+500]
+            rows = self._db.execute('SELECT key, text, positive, negative FROM posts WHERE key IN ({})'.format(
+                ','.join('?' * len(batch))), batch)
+            for key, text, positive, negative in rows:
+                found[key] = (text, bool(positive), bool(negative))
+        return found
+
+    def put_many(self, entries):
+        """
+        :param entries: iterable of (key, preprocessed text, positive flag, negative flag)
+        """
+        self._db.executemany('INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?, ?)',
+                             ((key, text, positive, negative, self._generation)
+                              for key, text, positive, negative in entries))
+
+    def touch(self, keys):
+        self._db.executemany('UPDATE posts SET last_used = ? WHERE key = ?',
+                             ((self._generation, key) for key in keys))
+
+    def commit(self):
+        """
+        Make the entries added by put_many and touch visible to the readers.
+        """
+        self._db.commit()
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM posts').fetchone()[0]
+
+    def evict(self):
+        """
+        Bound the cache to max_entries, removing the least recently used entries.
+        """
+        excess = len(self) - self._max_entries
+        if excess > 0:
+            self._db.execute('DELETE FROM posts WHERE key IN (SELECT key FROM posts ORDER BY last_used LIMIT ?)',
+                             (excess,))
+        self._db.commit()
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+
+def preprocess_cached(posts, preprocess, sentiment, cache=None):
+    """
+    Preprocess posts and compute their TermSentiment flags, using the cache when given.
+    :param posts: list of raw posts
+    :param preprocess: function preprocessing a list of posts
+    :param sentiment: TermSentiment instance
+    :param cache: optional readonly PreprocessCache
+    :return: tuple of (list of (preprocessed text, positive flag, negative flag), new cache entries, cache hit keys)
+    """
+    keys = [post_key(post) for post in posts]
+    cached = cache.get_many(keys) if cache is not None else {}
+
+    missing = [i for i, key in enumerate(keys) if key not in cached]
+    new_entries = []
+    for i, text in zip(missing, preprocess([posts[i] for i in missing])):
+        value = (text, sentiment.contains_positive_terms(text), sentiment.contains_negative_terms(text))
+        cached[keys[i]] = value
+        if cache is not None:
+            new_entries.append((keys[i],) + value)
+
+    missing = set(missing)
+    hit_keys = [key for i, key in enumerate(keys) if i not in missing] if cache is not None else []
+    return [cached[key] for key in keys], new_entries, hit_keys
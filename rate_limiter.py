@@ -0,0 +1,108 @@
+import threading
+import time
+
+import metrics
+
+# Twitter rate limit windows are 15 minutes long
+RATE_LIMIT_WINDOW = 15 * 60
+
+# minimal seconds to wait after the api reported a rate limit the bucket didn't expect
+RATE_LIMIT_BACKOFF = 60
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket following Twitter's rate limit windows:
+    the bucket holds the remaining requests and is refilled to its capacity when the window resets.
+    """
+    def __init__(self, capacity, window=RATE_LIMIT_WINDOW, remaining=None, reset=None):
+        self._capacity = capacity
+        self._window = window
+        self._tokens = capacity if remaining is None else remaining
+        self._reset = reset if reset is not None else time.time() + window
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_rate_limit_status(cls, rate_limit_status, resource='statuses', endpoint='/statuses/user_timeline'):
+        """
+        Create a bucket seeded from the response of the rate_limit_status api.
+        """
+        limits = rate_limit_status['resources'][resource][endpoint]
+        return cls(limits['limit'], remaining=limits['remaining'], reset=limits['reset'])
+
+    def update(self, remaining, reset):
+        with self._lock:
+            self._tokens = remaining
+            self._reset = reset
+
+    def update_from_rate_limit_status(self, rate_limit_status, resource='statuses',
+                                      endpoint='/statuses/user_timeline'):
+        limits = rate_limit_status['resources'][resource][endpoint]
+        self.update(limits['remaining'], limits['reset'])
+
+    def drain(self, reset=None):
+        """
+        Mark the bucket as empty until its window resets, used when the api reports a rate limit anyway.
+        The window is extended to at least RATE_LIMIT_BACKOFF seconds from now, so an api that still reports
+        a rate limit at the reset time isn't retried right away.
+        :param reset: optional reset time reported by the api
+        """
+        with self._lock:
+            self._tokens = 0
+            self._reset = max(reset if reset is not None else self._reset, time.time() + RATE_LIMIT_BACKOFF)
+
+    def try_acquire(self):
+        """
+        :return: 0 if a token was taken, otherwise the seconds until the bucket is refilled
+        """
+        with self._lock:
+            now = time.time()
+            if now >= self._reset:
+                self._tokens = self._capacity
+                self._reset = now + self._window
+            if self._tokens > 0:
+                self._tokens -= 1
+                return 0
+            return self._reset - now
+
+
+class ApiPool:
+    """
+    Pool of api clients, one per OAuth profile, each with its own token bucket.
+    Requests are spread round robin over the clients that still have quota,
+    and only block when every client has used up its window.
+    """
+    def __init__(self):
+        self._clients = []
+        self._next = 0
+        self._lock = threading.Lock()
+        self.sleeps = 0
+
+    def add(self, client, bucket):
+        self._clients.append((client, bucket))
+
+    def __len__(self):
+        return len(self._clients)
+
+    def acquire(self):
+        """
+        Block until one of the clients has quota left.
+        :return: tuple of (client, bucket)
+        """
+        while True:
+            with self._lock:
+                start = self._next
+                self._next = (self._next + 1) % len(self._clients)
+            waits = []
+            for i in range(len(self._clients)):
+                client, bucket = self._clients[(start + i) % len(self._clients)]
+                wait = bucket.try_acquire()
+                if not wait:
+                    return client, bucket
+                waits.append(wait)
+            wait = min(waits)
+            print('Going to sleep for {:.0f} seconds because we reached api rate limit'.format(wait))
+            self.sleeps += 1
+            metrics.registry.inc('rate_limit_sleeps_total')
+            metrics.registry.inc('rate_limit_sleep_seconds_total', wait)
+            time.sleep(wait)
@@ -1,25 +1,102 @@
 import argparse
 import json
 import logging
+import logging.handlers
+import os
+import select
+import signal
+import sys
 import time
+from array import array
+from collections import Counter
+from multiprocessing.pool import Pool
 
+import fast_json
+import metrics
+from bloom_filter import DEFAULT_CAPACITY, DEFAULT_ERROR_RATE, BloomFilter
+from capture_segments import ACTIVE_SEGMENT, CaptureSegments, is_compressed, line_created_at, open_capture, parse_date
 from terms_sentiment import TermSentiment
+from timestamps import parse_created_at
+
+# keys of quoted and retweeted tweets, checked on the raw line to avoid decoding tweets that are dropped anyway
+RETWEET_KEYS = ['quoted_status', 'quoted_status_permalink', 'retweeted_status']
+
+# byte size of the chunks a capture file is split into when using several processes
+CHUNK_SIZE = 64 * 1024 * 1024
+
+# number of verbose log records buffered before they are written to the log file
+LOG_BUFFER_SIZE = 1024
+
+# seconds between checks for new data when following a capture
+POLL_INTERVAL = 1.0
+
+# maximal seconds between a candidate arriving in streaming mode and it being saved to the output file
+FLUSH_INTERVAL = 5.0
+
+
+class UserPosts:
+    """
+    A candidate's posts, with the creation times in a float64 array instead of a tuple and float per post.
+    """
+    __slots__ = ('created_at', 'texts', 'hashtags')
+
+    def __init__(self):
+        self.created_at = array('d')
+        self.texts = []
+        self.hashtags = []
+
+    @classmethod
+    def from_json(cls, user_data):
+        posts = cls()
+        for created_at, text in user_data['posts']:
+            posts.created_at.append(created_at)
+            posts.texts.append(text)
+        posts.hashtags = [sys.intern(hashtag) for hashtag in user_data['hashtags']]
+        return posts
+
+    def add(self, created_at, text, hashtags):
+        self.created_at.append(created_at)
+        self.texts.append(text)
+        # the same hashtags are repeated over many tweets
+        self.hashtags.extend(sys.intern(hashtag) for hashtag in hashtags)
+
+    def to_json(self):
+        return {'posts': list(zip(self.created_at, self.texts)), 'hashtags': self.hashtags}
 
 
 class SchizophreniaCandidates:
-    def __init__(self, input_files, log_file, output_file):
+    def __init__(self, input_files, log_file, output_file, checkpoint_file=None, verbose=False, metrics_file=None,
+                 dedup_file=None, dedup_capacity=DEFAULT_CAPACITY, dedup_error_rate=DEFAULT_ERROR_RATE):
         self._sentiment = TermSentiment()
         self._input_files = input_files
         self._output_file = output_file
+        self._checkpoint_file = checkpoint_file
+        self._verbose = verbose
+        self._metrics_file = metrics_file
         self._logger = logging.getLogger('schizo_db')
+        self._log_buffer = None
         self._users = {}
+        # per line counters are kept locally and flushed to the metrics registry in bulk, see flush_metrics
+        self._lines_read = 0
+        self._drops = Counter()
+        # ids of the candidate tweets already added, replayed and overlapping tweets are only added once
+        self._dedup_file = dedup_file
+        self._seen_tweets = BloomFilter(dedup_capacity, dedup_error_rate) if dedup_file else None
+        self._saved_seen_tweets = 0
+
+        if log_file:
+            self._setup_logger(log_file)
 
-        # Setup logger
-        self._logger.setLevel(logging.DEBUG)
+    def _setup_logger(self, log_file):
+        # Setup logger, every candidate tweet is logged at debug level only when verbose
+        self._logger.setLevel(logging.DEBUG if self._verbose else logging.INFO)
 
-        # Create handlers
+        # Create handlers, the candidate tweets only go to the file and are written in batches
         stdout_handler = logging.StreamHandler()
+        stdout_handler.setLevel(logging.INFO)
         file_handler = logging.FileHandler(log_file, encoding='utf-8')
+        self._log_buffer = logging.handlers.MemoryHandler(LOG_BUFFER_SIZE, flushLevel=logging.INFO,
+                                                          target=file_handler)
 
         # Create formatters and add it to handlers
         stdout_handler.setFormatter(logging.Formatter('%(message)s'))
@@ -27,7 +104,7 @@ class SchizophreniaCandidates:
 
         # Add handlers to the logger
         self._logger.addHandler(stdout_handler)
-        self._logger.addHandler(file_handler)
+        self._logger.addHandler(self._log_buffer)
 
     @staticmethod
     def filter_out_retweets(tweet):
@@ -48,80 +125,551 @@ class SchizophreniaCandidates:
                 return False
         return True
 
-    def find_schizo_candidates(self, high_precision=False):
-        users = []
+    @staticmethod
+    def read_new_lines(file, offset=0, end=None, final=False):
+        """
+        Stream complete lines of a capture file starting at a byte offset.
+        A trailing line without a newline is not yielded since the capture service may still be writing it,
+        unless final is set and the line is a whole json document, as the last line of a finished file may be.
+        Compressed segments are decompressed on the fly, their offsets are positions in the decompressed data.
+        :param file: path to the capture file
+        :param offset: byte offset to start reading from
+        :param end: optional byte offset to stop at, must be aligned to a line boundary
+        :param final: whether to read a trailing line without a newline at the end of the file
+        :return: generator of (line, byte offset right after the line)
+        """
+        with open_capture(file) as f:
+            if offset:
+                f.seek(offset)
+            for line in f:
+                if end is not None and offset >= end:
+                    break
+                if not line.endswith(b'\n'):
+                    if not final:
+                        break
+                    try:
+                        fast_json.loads(line)
+                    except fast_json.DECODE_ERRORS:
+                        # a partially written line
+                        break
+                offset += len(line)
+                yield line.decode('utf-8'), offset
 
-        for file in self._input_files:
-            tweet_counter = 0
+    @staticmethod
+    def follow_lines(file, offset=0, poll_interval=POLL_INTERVAL):
+        """
+        Tail a capture file which is still being written, forever.
+        When the file is rotated (replaced by a new file) the rest of the old file is read first,
+        when it is truncated reading starts over at its beginning.
+        :param file: path to the capture file
+        :param offset: byte offset to start reading from
+        :param poll_interval: seconds to wait for new data
+        :return: generator of (line, byte offset right after the line), or None whenever no data is available
+        """
+        while not os.path.isfile(file):
+            yield None
+            time.sleep(poll_interval)
+        f = open(file, 'rb')
+        try:
+            f.seek(offset)
+            inode = os.fstat(f.fileno()).st_ino
+            while True:
+                line = f.readline()
+                if line.endswith(b'\n'):
+                    offset += len(line)
+                    yield line.decode('utf-8'), offset
+                    continue
 
-            with open(file, encoding='utf-8') as f:
-                for line in f.read().splitlines():
-                    if not line or not line.strip():
-                        continue
-                    if 'EOFError' in line:
-                        continue
+                # a partial line is read again once the capture service finished writing it
+                f.seek(offset)
+                yield None
+                time.sleep(poll_interval)
+                try:
+                    stat = os.stat(file)
+                except FileNotFoundError:
+                    stat = None
+                if stat and stat.st_ino == inode and stat.st_size >= offset:
+                    continue
 
-                    try:
-                        tweet = json.loads(line, encoding='utf-8')
-                    except json.decoder.JSONDecodeError:
-                        continue
-                    if self.filter_out_retweets(tweet):
-                        continue
-
-                    # prefer 'full_text', otherwise take 'text' minus the link at the end
-                    tweet_text = tweet['extended_tweet']['full_text'] if 'extended_tweet' in tweet else tweet['text']
-                    tweet_text = tweet_text.lower()
-
-                    if self.filter_out_adds(tweet_text):
-                        continue
-
-                    if high_precision:
-                        if not self._sentiment.contains_positive_terms(tweet_text):
-                            continue
-                        if self._sentiment.contains_negative_terms(tweet_text):
-                            continue
-                    else:
-                        if self.filter_in_self_terms(tweet_text):
-                            continue
-                        if 'diagnos' not in tweet_text:
-                            continue
-
-                    user_id = tweet['user']['id']
-                    created_at = tweet['created_at']
-                    created_at = time.mktime(time.strptime(created_at, "%a %b %d %H:%M:%S +0000 %Y"))
-                    hashtags = tweet['entities']['hashtags']
-                    hashtags = [hashtag['text'] for hashtag in hashtags]
-
-                    if user_id not in self._users:
-                        self._users[user_id] = {
-                            'posts': [],
-                            'hashtags': []
-                        }
-                    self._users[user_id]['posts'].append((created_at, tweet_text))
-                    self._users[user_id]['hashtags'].extend(hashtags)
-
-                    self._logger.info(tweet_text)
-                    self._logger.info('-----------------------------------------------------------------')
-                    tweet_counter += 1
-                    users += [user_id]
+                if not stat or stat.st_ino != inode:
+                    # rotated, finish the old file first
+                    for line in f:
+                        if not line.endswith(b'\n'):
+                            break
+                        offset += len(line)
+                        yield line.decode('utf-8'), offset
+                    f.seek(offset)
+                if not stat:
+                    # the new file isn't created yet
+                    continue
+                f.close()
+                f = open(file, 'rb')
+                inode = os.fstat(f.fileno()).st_ino
+                offset = 0
+        finally:
+            f.close()
+
+    @staticmethod
+    def stream_lines(stream, poll_interval=POLL_INTERVAL):
+        """
+        Read lines from a pipe, e.g. stdin piped from twurl, until it is closed.
+        :return: generator of (line, None), or None whenever no data is available
+        """
+        fd = stream.fileno()
+        pending = b''
+        while True:
+            readable, _, _ = select.select([fd], [], [], poll_interval)
+            if not readable:
+                yield None
+                continue
+            data = os.read(fd, 1024 * 1024)
+            if not data:
+                break
+            lines = (pending + data).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line.decode('utf-8') + '\n', None
+        # the last tweet has no newline when the writer was stopped, a cut off one is dropped as invalid json
+        if pending:
+            yield pending.decode('utf-8', 'replace') + '\n', None
+
+    @staticmethod
+    def replay_lines(file, speed=1.0, poll_interval=POLL_INTERVAL):
+        """
+        Replay a recorded capture file, pacing the lines by their tweets' creation time.
+        :param file: path to the capture file
+        :param speed: multiple of the original rate to replay at, 0 to replay as fast as possible
+        :return: generator of (line, None), or None while waiting for the next line
+        """
+        first_created_at = None
+        start_time = time.time()
+        for line, _ in SchizophreniaCandidates.read_new_lines(file):
+            created_at = line_created_at(line) if speed else None
+            if created_at is not None:
+                if first_created_at is None:
+                    first_created_at = created_at
+                wait = (created_at - first_created_at) / speed - (time.time() - start_time)
+                while wait > 0:
+                    time.sleep(min(wait, poll_interval))
+                    yield None
+                    wait = (created_at - first_created_at) / speed - (time.time() - start_time)
+            yield line, None
+
+    @staticmethod
+    def split_file(file, start, n_chunks):
+        """
+        Split the complete lines of a capture file into byte ranges aligned to line boundaries.
+        :param file: path to the capture file
+        :param start: byte offset to start from
+        :param n_chunks: minimal number of chunks to split into
+        :return: list of (start, end) byte ranges
+        """
+        with open(file, 'rb') as f:
+            # the end of the last complete line
+            end = f.seek(0, os.SEEK_END)
+            while end > start:
+                f.seek(max(end - CHUNK_SIZE, start))
+                block = f.read(end - f.tell())
+                newline = block.rfind(b'\n')
+                if newline != -1:
+                    end = end - len(block) + newline + 1
+                    break
+                end -= len(block)
+
+            n_chunks = max(n_chunks, (end - start) // CHUNK_SIZE + 1)
+            boundaries = [start]
+            for i in range(1, n_chunks):
+                boundary = start + (end - start) * i // n_chunks
+                if boundary <= boundaries[-1]:
+                    continue
+                # move the boundary to the beginning of the next line
+                f.seek(boundary - 1)
+                f.readline()
+                boundary = min(f.tell(), end)
+                if boundary > boundaries[-1]:
+                    boundaries.append(boundary)
+            if end > boundaries[-1]:
+                boundaries.append(end)
+        return list(zip(boundaries[:-1], boundaries[1:]))
+
+    def _load_checkpoint(self):
+        if not self._checkpoint_file or not os.path.isfile(self._checkpoint_file):
+            return {}
+        return fast_json.load_file(self._checkpoint_file)
+
+    def _save(self, checkpoint):
+        with metrics.registry.timer('stage_seconds', stage='save'):
+            self._dump_users(self._output_file)
+            if self._seen_tweets is not None and len(self._seen_tweets) != self._saved_seen_tweets:
+                self._seen_tweets.save(self._dedup_file)
+                self._saved_seen_tweets = len(self._seen_tweets)
+            if self._checkpoint_file and checkpoint is not None:
+                self._dump_json(checkpoint, self._checkpoint_file)
+        if self._log_buffer:
+            self._log_buffer.flush()
+        if self._metrics_file:
+            metrics.registry.export(self._metrics_file)
+
+    def _load_previous_candidates(self):
+        if os.path.isfile(self._output_file):
+            self._users = {user_id: UserPosts.from_json(user_data)
+                           for user_id, user_data in fast_json.load_file(self._output_file).items()}
+            # the seen tweets are only kept along with the candidates they were added to
+            if self._seen_tweets is not None and os.path.isfile(self._dedup_file):
+                self._seen_tweets = BloomFilter.load(self._dedup_file)
+                self._saved_seen_tweets = len(self._seen_tweets)
+
+    @staticmethod
+    def _dump_json(obj, path):
+        # write to a temporary file first so an interrupted run never leaves a half-written file behind
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as out:
+            json.dump(obj, out)
+            metrics.registry.inc('bytes_written_total', out.tell(), file=os.path.basename(path))
+        os.replace(tmp_path, path)
+
+    def _dump_users(self, path):
+        """
+        Write the candidates in the same json format as a dict of {'posts', 'hashtags'} dicts,
+        one user at a time so the whole output is never built in memory.
+        """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as out:
+            out.write('{')
+            for i, (user_id, posts) in enumerate(self._users.items()):
+                if i:
+                    out.write(', ')
+                out.write(json.dumps(user_id))
+                out.write(': ')
+                json.dump(posts.to_json(), out)
+            out.write('}')
+            metrics.registry.inc('bytes_written_total', out.tell(), file=os.path.basename(path))
+        os.replace(tmp_path, path)
+
+    def parse_candidate(self, line, high_precision=False):
+        """
+        Run a raw capture line through the filtering chain.
+        :return: tuple of (user_id, created_at, tweet_text, hashtags, tweet_id) if the tweet is a candidate,
+                 None otherwise
+        """
+        self._lines_read += 1
+        if not line or not line.strip():
+            self._drops['empty'] += 1
+            return None
+        if 'EOFError' in line:
+            self._drops['eof_error'] += 1
+            return None
+
+        if any(fast_json.has_key(line, key) for key in RETWEET_KEYS):
+            self._drops['retweet'] += 1
+            return None
+
+        try:
+            tweet = fast_json.loads(line)
+        except fast_json.DECODE_ERRORS:
+            self._drops['invalid_json'] += 1
+            return None
+        if self.filter_out_retweets(tweet):
+            self._drops['retweet'] += 1
+            return None
+
+        # prefer 'full_text', otherwise take 'text' minus the link at the end
+        tweet_text = tweet['extended_tweet']['full_text'] if 'extended_tweet' in tweet else tweet['text']
+        tweet_text = tweet_text.lower()
+
+        if self.filter_out_adds(tweet_text):
+            self._drops['ads'] += 1
+            return None
+
+        if high_precision:
+            if not self._sentiment.contains_positive_terms(tweet_text):
+                self._drops['no_positive_term'] += 1
+                return None
+            if self._sentiment.contains_negative_terms(tweet_text):
+                self._drops['negative_term'] += 1
+                return None
+        else:
+            if self.filter_in_self_terms(tweet_text):
+                self._drops['self_terms'] += 1
+                return None
+            if 'diagnos' not in tweet_text:
+                self._drops['no_diagnosis'] += 1
+                return None
+
+        user_id = str(tweet['user']['id'])
+        created_at = parse_created_at(tweet['created_at'])
+        hashtags = tweet['entities']['hashtags']
+        hashtags = [hashtag['text'] for hashtag in hashtags]
+        return user_id, created_at, tweet_text, hashtags, str(tweet['id'])
+
+    def flush_metrics(self):
+        """
+        Move the per line counters of parse_candidate to the metrics registry.
+        """
+        metrics.registry.inc('lines_read_total', self._lines_read)
+        for filter_name, count in self._drops.items():
+            metrics.registry.inc('lines_dropped_total', count, filter=filter_name)
+        self._lines_read = 0
+        self._drops.clear()
+
+    def add_candidate(self, user_id, created_at, tweet_text, hashtags, tweet_id=None):
+        """
+        :return: False if the tweet was already added
+        """
+        if self._seen_tweets is not None and tweet_id is not None:
+            if not self._seen_tweets.add(tweet_id):
+                metrics.registry.inc('lines_dropped_total', filter='duplicate')
+                return False
+            if len(self._seen_tweets) == self._seen_tweets.capacity + 1:
+                self._logger.warning('More than {} candidate tweets were seen, duplicates are detected with '
+                                     'a growing error rate, consider a larger --dedup_capacity'.format(
+                                         self._seen_tweets.capacity))
+        if user_id not in self._users:
+            self._users[user_id] = UserPosts()
+        self._users[user_id].add(created_at, tweet_text, hashtags)
+        metrics.registry.inc('candidates_total')
+
+        if self._verbose:
+            self._logger.debug(tweet_text)
+            self._logger.debug('-----------------------------------------------------------------')
+        return True
+
+    def input_files(self, since=None, until=None):
+        """
+        :return: the input capture files, with segment directories replaced by their completed segments
+        which overlap the time window
+        """
+        files = []
+        for path in self._input_files:
+            if os.path.isdir(path):
+                files.extend(CaptureSegments(path).segments(since, until))
+            else:
+                files.append(path)
+        return files
+
+    def _scan_jobs(self, files, checkpoint, n_processes):
+        """
+        :return: list of (file, start, end) byte ranges left to scan
+        """
+        jobs = []
+        for file in files:
+            file_key = os.path.abspath(file)
+            offset = checkpoint.get(file_key, 0)
+            size = os.path.getsize(file)
+            if is_compressed(file):
+                # compressed segments are never appended to, they are read whole and checkpointed by their size
+                if offset != size:
+                    jobs.append((file, 0, size))
+                continue
+
+            if offset > size:
+                # the capture file was truncated or replaced, start over
+                offset = 0
+                checkpoint[file_key] = 0
+            if n_processes > 1:
+                ranges = self.split_file(file, offset, n_processes)
+                # the last chunk reads on to the end of the file, so a last line without a newline is read as well
+                ranges = ranges[:-1] + [(ranges[-1][0] if ranges else offset, None)]
+                jobs.extend((file, start, end) for start, end in ranges)
+            else:
+                jobs.append((file, offset, None))
+        return jobs
+
+    def scan_chunk(self, file, start, end, high_precision=False):
+        """
+        :return: tuple of (list of candidates in a byte range of a capture file, byte offset reached)
+        """
+        candidates = []
+        offset = start
+        with metrics.registry.timer('stage_seconds', stage='scan_chunk'):
+            # compressed segments are read whole, their offsets don't match the compressed file
+            for line, offset in self.read_new_lines(file, start, None if is_compressed(file) else end, final=True):
+                candidate = self.parse_candidate(line, high_precision)
+                if candidate:
+                    candidates.append(candidate)
+        self.flush_metrics()
+        return candidates, end if is_compressed(file) else offset
+
+    def _merge_chunks(self, files, jobs, results, checkpoint):
+        """
+        Add the candidates of the scanned chunks in the order of the jobs and log the counts per file.
+        :param results: iterable of (chunk candidates, byte offset reached, worker metrics or None) per job
+        """
+        n_candidates = 0
+        users = set()
+        file_counters = {file: 0 for file in files}
+        with metrics.registry.timer('stage_seconds', stage='scan'):
+            for (file, start, _), (chunk_candidates, end, chunk_metrics) in zip(jobs, results):
+                if chunk_metrics:
+                    metrics.registry.merge(chunk_metrics)
+                for candidate in chunk_candidates:
+                    if self.add_candidate(*candidate):
+                        users.add(candidate[0])
+                        n_candidates += 1
+                        file_counters[file] += 1
+                checkpoint[os.path.abspath(file)] = end
+                metrics.registry.inc('bytes_read_total', end - start)
+                metrics.registry.maybe_export(self._metrics_file)
+        for file, tweet_counter in file_counters.items():
             self._logger.info('*****************************************************************')
             self._logger.info('Found {counter} schizophrenia candidates in {file}'.format(
                 counter=tweet_counter, file=file))
             self._logger.info('*****************************************************************')
-        self._logger.info('Out of {} users, there are {} unique'.format(len(users), len(set(users))))
+        self._logger.info('Out of {} users, there are {} unique'.format(n_candidates, len(users)))
+
+    def find_schizo_candidates(self, high_precision=False, from_start=False, n_processes=1, since=None, until=None):
+        """
+        Scan the capture files for candidate tweets.
+        Unless from_start is set, each file is only read from the offset reached by the previous run
+        and the new candidates are merged into the existing output file.
+        With several processes, plain files are split into line aligned chunks and compressed segments
+        are decompressed whole, which are filtered in parallel and merged back in order,
+        so the output is the same as the serial one.
+        :param since: optional unix timestamp, segments with only older tweets are skipped
+        :param until: optional unix timestamp, segments with only newer tweets are skipped
+        """
+        checkpoint = {} if from_start else self._load_checkpoint()
+        if checkpoint:
+            self._load_previous_candidates()
+        files = self.input_files(since, until)
+        jobs = self._scan_jobs(files, checkpoint, n_processes)
+
+        if n_processes > 1:
+            with Pool(processes=n_processes, initializer=_init_worker) as pool:
+                results = pool.imap(_find_chunk_candidates, [job + (high_precision,) for job in jobs])
+                self._merge_chunks(files, jobs, results, checkpoint)
+        else:
+            results = (self.scan_chunk(*job, high_precision=high_precision) + (None,) for job in jobs)
+            self._merge_chunks(files, jobs, results, checkpoint)
+
+        self._save(checkpoint)
+
+    def stream_candidates(self, lines, high_precision=False, from_start=False, checkpoint_key=None,
+                          flush_interval=FLUSH_INTERVAL):
+        """
+        Consume capture lines as they arrive, e.g. from follow_lines, stream_lines or replay_lines.
+        New candidates are merged into the output file at most flush_interval seconds after they arrive,
+        so the output is always close to up to date and a restart loses little work.
+        :param lines: generator of (line, byte offset right after the line), or None whenever no data is available
+        :param checkpoint_key: key of the byte offsets in the checkpoint file, None for sources without offsets
+        """
+        checkpoint = None
+        if checkpoint_key:
+            checkpoint = {} if from_start else self._load_checkpoint()
+        if not from_start:
+            self._load_previous_candidates()
+
+        pending = 0
+        last_flush = time.time()
+        try:
+            for item in lines:
+                if item:
+                    line, offset = item
+                    candidate = self.parse_candidate(line, high_precision)
+                    if candidate and self.add_candidate(*candidate):
+                        pending += 1
+                    if checkpoint_key:
+                        checkpoint[checkpoint_key] = offset
+
+                if time.time() - last_flush >= flush_interval:
+                    self.flush_metrics()
+                    if pending:
+                        self._logger.info('Found {} new schizophrenia candidates'.format(pending))
+                    self._save(checkpoint)
+                    pending = 0
+                    last_flush = time.time()
+        finally:
+            self.flush_metrics()
+            self._save(checkpoint)
+
+    def follow_candidates(self, file, high_precision=False, from_start=False, flush_interval=FLUSH_INTERVAL):
+        """
+        Stream the candidates of a capture file while it's being written, starting from the checkpoint offset.
+        :param file: capture file, or segments directory to follow the active segment of
+        """
+        if os.path.isdir(file):
+            file = os.path.join(file, ACTIVE_SEGMENT)
+        file_key = os.path.abspath(file)
+        checkpoint = {} if from_start else self._load_checkpoint()
+        offset = checkpoint.get(file_key, 0)
+        if not os.path.isfile(file) or offset > os.path.getsize(file):
+            offset = 0
+        self.stream_candidates(self.follow_lines(file, offset), high_precision, from_start, file_key, flush_interval)
+
+
+_worker_candidates = None
+
+
+def _init_worker():
+    global _worker_candidates
+    _worker_candidates = SchizophreniaCandidates(input_files=[], log_file=None, output_file=None)
+
 
-        with open(self._output_file, 'w', encoding='utf-8') as out:
-            json.dump(self._users, out)
+def _find_chunk_candidates(args):
+    file, start, end, high_precision = args
+    chunk_candidates, end = _worker_candidates.scan_chunk(file, start, end, high_precision)
+    # the worker's metrics are sent along with each chunk and merged by the parent
+    return chunk_candidates, end, metrics.registry.snapshot()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prefix_chars='--')
-    parser.add_argument('--input', type=str, nargs='+', required=True, help='Input files to process')
+    parser.add_argument('--input', type=str, nargs='+', required=True,
+                        help='Input files to process, plain or compressed, or capture segment directories')
     parser.add_argument('--log', type=str, default='candidates.txt', help='Optional log file')
     parser.add_argument('--output', type=str, default='candidates.json', help='Optional output file')
     parser.add_argument('-hp', '--high_precision', action='store_true', default=False,
                         help='Set this to perform a search for candidates using SMHD high precision patterns.')
+    parser.add_argument('--checkpoint', type=str, default='candidates_checkpoint.json',
+                        help='Optional checkpoint file with the byte offset reached in each input file')
+    parser.add_argument('--from_start', action='store_true', default=False,
+                        help='Ignore the checkpoint, read the input files from the beginning and overwrite the output')
+    parser.add_argument('--n_processes', type=int, default=1, help='How many processes to use for runtime speedup')
+    parser.add_argument('--verbose', action='store_true', default=False,
+                        help='Also write the text of every candidate tweet to the log file')
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='Optional metrics file, json if it ends with .json, Prometheus textfile format otherwise')
+    parser.add_argument('--follow', action='store_true', default=False,
+                        help='Keep running and filter the tweets appended to the input file as they arrive. '
+                             'Use - as input to read the filter stream piped from twurl instead')
+    parser.add_argument('--replay_speed', type=float, default=None,
+                        help='Replay the recorded input files through the streaming consumer, '
+                             'at this multiple of their original rate (0 as fast as possible)')
+    parser.add_argument('--since', type=parse_date, default=None,
+                        help='Optional YYYY-MM-DD date, segments with only older tweets are skipped')
+    parser.add_argument('--until', type=parse_date, default=None,
+                        help='Optional YYYY-MM-DD date, segments with only newer tweets are skipped')
+    parser.add_argument('--flush_interval', type=float, default=FLUSH_INTERVAL,
+                        help='Maximal seconds before a streamed candidate is saved to the output file')
+    parser.add_argument('--dedup', type=str, default='candidates_seen.bloom',
+                        help='Bloom filter file of the candidate tweet ids already added, so tweets replayed by '
+                             'the capture service or found in overlapping inputs are only added once. '
+                             'Pass an empty string to disable')
+    parser.add_argument('--dedup_capacity', type=int, default=DEFAULT_CAPACITY,
+                        help='Number of candidate tweets the dedup filter is sized for, when it is created')
+    parser.add_argument('--dedup_error_rate', type=float, default=DEFAULT_ERROR_RATE,
+                        help='Probability of a new candidate tweet being dropped as a duplicate, when the filter '
+                             'is created')
     options = parser.parse_args()
+    if options.follow and len(options.input) != 1:
+        parser.error('--follow takes a single input')
 
-    candidates = SchizophreniaCandidates(options.input, options.log, options.output)
-    candidates.find_schizo_candidates(options.high_precision)
+    candidates = SchizophreniaCandidates(options.input, options.log, options.output, options.checkpoint,
+                                         options.verbose, options.metrics, options.dedup, options.dedup_capacity,
+                                         options.dedup_error_rate)
+    # let the streaming consumer save its candidates when stopped by its service manager
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if options.follow and options.input[0] == '-':
+        candidates.stream_candidates(candidates.stream_lines(sys.stdin), options.high_precision, options.from_start,
+                                     flush_interval=options.flush_interval)
+    elif options.follow:
+        candidates.follow_candidates(options.input[0], options.high_precision, options.from_start,
+                                     options.flush_interval)
+    elif options.replay_speed is not None:
+        lines = (line for file in candidates.input_files(options.since, options.until)
+                 for line in candidates.replay_lines(file, options.replay_speed))
+        candidates.stream_candidates(lines, options.high_precision, options.from_start,
+                                     flush_interval=options.flush_interval)
+    else:
+        candidates.find_schizo_candidates(options.high_precision, options.from_start, options.n_processes,
+                                          options.since, options.until)
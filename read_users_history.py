@@ -1,90 +1,232 @@
-import json
 import os
+import threading
 import time
 from argparse import ArgumentParser
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from multiprocessing.pool import Pool
 
 import tweepy
 import yaml
 
-from data.skip_users import SKIP_USERS
+import fast_json
+import metrics
+from capture_segments import CaptureSegments, open_capture, parse_date
+from columnar_history import ColumnarHistory, ColumnarHistoryWriter
+from rate_limiter import ApiPool, TokenBucket
+from skip_cache import SkipCache
+from user_store import UserStore
+
+# users resolved by a single users/lookup request
+LOOKUP_BATCH_SIZE = 100
+
+# api error code of a users/lookup request none of whose users exist
+NO_USER_MATCHES_API_CODE = 17
+
+# rate limited attempts of a single request before it's given up as failed
+MAX_RATE_LIMIT_RETRIES = 5
+
+# users submitted to the fetching threads ahead of them, per thread
+PENDING_USERS_PER_THREAD = 2
 
 
 class UserTweetFetcher:
-    def __init__(self, config_path, save_path, users_paths, num_tweets, raw_data):
+    def __init__(self, config_path, save_path, users_paths, num_tweets, raw_data, store_path, n_threads=1,
+                 metrics_file=None, since=None, until=None, prescreen=True, skip_cache_path='skipped_users.jsonl'):
         self._api = None
+        self._api_pool = None
+        self._lookup_pool = None
+        self._prescreen = prescreen
+        self._n_threads = n_threads
+        self._lock = threading.Lock()
         self._num_tweets = num_tweets
         self._config_path = config_path
         self._save_path = save_path
         self._users_paths = users_paths
         self._raw_data = raw_data
-        self._users_written = 0
-        self._users_tweets = {}
+        self._store_path = store_path
+        self._users_tweets = None
+        self._skip_cache_path = skip_cache_path
+        self._skipped_users = None
+        self._metrics_file = metrics_file
+        self._since = since
+        self._until = until
 
     def create_api(self):
+        """
+        Create an api client for every OAuth profile in the twurl config.
+        Each profile has its own rate limit, so requests are spread over all of them.
+        """
         with open(self._config_path) as f:
             oauth_config = yaml.load(f, Loader=yaml.FullLoader)
-        info = oauth_config['profiles']['user']
-        info = info[list(info.keys())[0]]
-        consumer_key = info['consumer_key']
-        consumer_secret = info['consumer_secret']
-        access_token = info['token']
-        access_token_secret = info['secret']
 
-        # Authorization to consumer key and consumer secret
-        auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
+        apis = []
+        for profile in oauth_config['profiles'].values():
+            for info in profile.values():
+                consumer_key = info['consumer_key']
+                consumer_secret = info['consumer_secret']
+                access_token = info['token']
+                access_token_secret = info['secret']
+
+                # Authorization to consumer key and consumer secret
+                auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
+
+                # Access to user's access key and access secret
+                auth.set_access_token(access_token, access_token_secret)
 
-        # Access to user's access key and access secret
-        auth.set_access_token(access_token, access_token_secret)
+                # Calling api
+                apis.append(tweepy.API(auth))
+        self.set_apis(apis)
 
-        # Calling api
-        self._api = tweepy.API(auth)
+    def set_apis(self, apis):
+        """
+        Use the given api clients, seeding each client's token bucket from its current rate limit status.
+        :param apis: list of tweepy.API compatible clients
+        """
+        self._api = apis[0]
+        self._api_pool = ApiPool()
+        self._lookup_pool = ApiPool()
+        for api in apis:
+            rate_limit_status = api.rate_limit_status()
+            self._api_pool.add(api, TokenBucket.from_rate_limit_status(rate_limit_status))
+            self._lookup_pool.add(api, TokenBucket.from_rate_limit_status(rate_limit_status, 'users', '/users/lookup'))
+        print('Using {} api profiles'.format(len(self._api_pool)))
 
     @staticmethod
     def _read_twitter_raw_data(json_path):
         users = []
-        with open(json_path) as f:
+        with open_capture(json_path) as f:
             for user in f:
                 try:
-                    user_json = json.loads(user)
-                    users.append(user_json['user']['id_str'])
+                    user_id, = fast_json.extract(user, ('user', 'id_str'))
+                    users.append(user_id)
                 except KeyError:
                     pass
-                except json.decoder.JSONDecodeError:
+                except fast_json.DECODE_ERRORS:
                     pass
         return users
 
     @staticmethod
     def _read_twitter_user_json(json_path):
-        with open(json_path) as f:
-            users = json.load(f)
+        if ColumnarHistory.is_columnar(json_path):
+            return ColumnarHistory(json_path).user_ids()
+        users = fast_json.load_file(json_path)
         return users.keys()
 
+    def _read_raw_users(self):
+        """
+        Read the user ids of raw capture files, plain or compressed, and of capture segment directories.
+        Several files are decompressed and parsed in parallel.
+        """
+        files = []
+        for path in self._users_paths:
+            if os.path.isdir(path):
+                files.extend(CaptureSegments(path).segments(self._since, self._until))
+            else:
+                files.append(path)
+        if len(files) < 2:
+            return [user_id for file in files for user_id in self._read_twitter_raw_data(file)]
+
+        with Pool(processes=min(len(files), os.cpu_count())) as pool:
+            return [user_id for users in pool.imap(self._read_twitter_raw_data, files) for user_id in users]
+
     def _load_cache(self):
-        if os.path.isfile(self._save_path):
-            with open(self._save_path) as f:
-                self._users_tweets = json.load(f)
+        if self._users_tweets is not None:
+            return
+        self._users_tweets = UserStore(self._store_path)
+        self._skipped_users = SkipCache(self._skip_cache_path)
+        # migrate a cache saved in the json format before the store existed
+        if not len(self._users_tweets) and os.path.isfile(self._save_path):
+            print('Importing user entries from {}'.format(self._save_path))
+            self._users_tweets.import_json(self._save_path)
+
+    def close(self):
+        """
+        Close the user store and the skip cache.
+        """
+        if self._users_tweets is not None:
+            self._users_tweets.close()
+            self._skipped_users.close()
+            self._users_tweets = None
+            self._skipped_users = None
+
+    def import_skip_users(self, path):
+        """
+        Never fetch the users listed in a file, one user id per line.
+        """
+        self._load_cache()
+        print('Skipping {} more users from {}'.format(self._skipped_users.import_users(path), path))
+
+    def print_skip_stats(self):
+        self._load_cache()
+        for reason, count in self._skipped_users.stats().most_common():
+            print('{}: {}'.format(reason, count))
+
+    def _skip_user(self, user_id, reason):
+        self._skipped_users.add(user_id, reason)
+        metrics.registry.inc('users_dropped_total', reason=reason)
 
     def save_users(self):
-        with open(self._save_path, 'w', encoding='utf-8') as out:
-            print('Saving {} user entries'.format(len(self._users_tweets)))
-            json.dump(self._users_tweets, out)
+        """
+        Export the stored users to save_path in the json format used by the rest of the pipeline.
+        """
+        self._load_cache()
+        print('Saving {} user entries'.format(len(self._users_tweets)))
+        self._users_tweets.export_json(self._save_path)
+
+    def save_users_columnar(self, directory):
+        """
+        Export the stored users to the columnar history format.
+        """
+        self._load_cache()
+        print('Saving {} user entries to {}'.format(len(self._users_tweets), directory))
+        writer = ColumnarHistoryWriter(directory)
+        for user_id, user_data in self._users_tweets.items():
+            writer.add_user(user_id, user_data)
+        writer.close()
 
     def get_tweets(self):
         self._load_cache()
         users_list = []
-        for user in self._users_paths:
-            if self._raw_data:
-                users_list.extend(self._read_twitter_raw_data(user))
-            else:
+        if self._raw_data:
+            users_list = self._read_raw_users()
+        else:
+            for user in self._users_paths:
                 users_list.extend(self._read_twitter_user_json(user))
 
         print('Getting tweets from {} users'.format(len(users_list)))
-        for user_id in users_list:
-            # no need to use api if we already have tweets for this user
-            if user_id in SKIP_USERS:
-                continue
-            if user_id not in self._users_tweets:
-                self.get_user_tweets(user_id)
+        metrics.registry.inc('users_read_total', len(users_list))
+        # no need to use api if we already have tweets for this user
+        unique_users = list(dict.fromkeys(users_list))
+        users_list = [user_id for user_id in unique_users if user_id not in self._skipped_users]
+        metrics.registry.inc('users_dropped_total', len(unique_users) - len(users_list), reason='skip_cache')
+        unique_users = users_list
+        users_list = [user_id for user_id in unique_users if user_id not in self._users_tweets]
+        metrics.registry.inc('users_dropped_total', len(unique_users) - len(users_list), reason='stored')
+        if self._prescreen:
+            users_list = self.prescreen_users(users_list)
+
+        # the api calls are io bound, so several users are fetched concurrently sharing the api pool quota.
+        # only a window of users is submitted at once, so an interrupted run doesn't wait for the whole backlog
+        with ThreadPoolExecutor(max_workers=self._n_threads) as executor:
+            pending = set()
+            try:
+                for user_id in users_list:
+                    if len(pending) >= PENDING_USERS_PER_THREAD * self._n_threads:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                            metrics.registry.maybe_export(self._metrics_file)
+                    pending.add(executor.submit(self.get_user_tweets, user_id))
+                for future in pending:
+                    future.result()
+                    metrics.registry.maybe_export(self._metrics_file)
+            except BaseException:
+                # only wait for the users being fetched, not the ones submitted ahead
+                executor.shutdown(cancel_futures=True)
+                raise
+        if self._metrics_file:
+            metrics.registry.export(self._metrics_file)
 
     def _get_user_timeline(self, user_id, count, max_id=None):
         """
@@ -97,44 +239,138 @@ class UserTweetFetcher:
         :param max_id: maximum post id number when using the api several times on the same user
         :return: list of tweets from user timeline
         """
-        try:
-            if max_id:
-                tweets = self._api.user_timeline(user_id=user_id, count=count, exclude_replies=True, include_rts=False,
-                                                 tweet_mode="extended", max_id=max_id)
+        for _ in range(MAX_RATE_LIMIT_RETRIES):
+            api, bucket = self._api_pool.acquire()
+            start_time = time.perf_counter()
+            try:
+                if max_id:
+                    tweets = api.user_timeline(user_id=user_id, count=count, exclude_replies=True, include_rts=False,
+                                               tweet_mode="extended", max_id=max_id)
+                else:
+                    tweets = api.user_timeline(user_id=user_id, count=count, exclude_replies=True, include_rts=False,
+                                               tweet_mode="extended")
+            except tweepy.RateLimitError:
+                metrics.registry.inc('api_calls_total', endpoint='user_timeline', status='rate_limited')
+                # our bucket is out of sync with the api, wait for the window reset and retry
+                self._reseed_bucket(api, bucket)
+                continue
+            except tweepy.TweepError:
+                metrics.registry.inc('api_calls_total', endpoint='user_timeline', status='error')
+                tweets = None
             else:
-                tweets = self._api.user_timeline(user_id=user_id, count=count, exclude_replies=True, include_rts=False,
-                                                 tweet_mode="extended")
+                metrics.registry.inc('api_calls_total', endpoint='user_timeline', status='ok')
+            metrics.registry.observe('api_call_seconds', time.perf_counter() - start_time, endpoint='user_timeline')
+            return tweets
+        print('Giving up on user {} after {} rate limited requests'.format(user_id, MAX_RATE_LIMIT_RETRIES))
+        return None
+
+    @staticmethod
+    def _reseed_bucket(api, bucket, resource='statuses', endpoint='/statuses/user_timeline'):
+        """
+        Empty a bucket whose request was rate limited until the window reset reported by the api.
+        The remaining requests the api reports are ignored, since the rate limit just proved them wrong.
+        """
+        try:
+            reset = api.rate_limit_status()['resources'][resource][endpoint]['reset']
         except tweepy.TweepError:
-            tweets = None
-        return tweets
+            reset = None
+        bucket.drain(reset)
+
+    def _lookup_users(self, user_ids):
+        """
+        Use Twitter api to receive the profiles of up to 100 users.
+        :return: list of the existing users' profiles, or None if the request failed
+        """
+        for _ in range(MAX_RATE_LIMIT_RETRIES):
+            api, bucket = self._lookup_pool.acquire()
+            start_time = time.perf_counter()
+            try:
+                users = api.lookup_users(user_ids=user_ids)
+            except tweepy.RateLimitError:
+                metrics.registry.inc('api_calls_total', endpoint='users_lookup', status='rate_limited')
+                self._reseed_bucket(api, bucket, 'users', '/users/lookup')
+                continue
+            except tweepy.TweepError as e:
+                if getattr(e, 'api_code', None) == NO_USER_MATCHES_API_CODE:
+                    metrics.registry.inc('api_calls_total', endpoint='users_lookup', status='ok')
+                    users = []
+                else:
+                    metrics.registry.inc('api_calls_total', endpoint='users_lookup', status='error')
+                    users = None
+            else:
+                metrics.registry.inc('api_calls_total', endpoint='users_lookup', status='ok')
+            metrics.registry.observe('api_call_seconds', time.perf_counter() - start_time, endpoint='users_lookup')
+            return users
+        return None
+
+    def _screen_user(self, user):
+        """
+        :return: the reason a user can't have enough tweets according to their profile, or None
+        """
+        if user.protected:
+            return 'protected'
+        # the status count also includes replies and retweets, so it's an upper bound on the usable tweets
+        if user.statuses_count < self._num_tweets:
+            return 'few_statuses'
+        # the profile language is deprecated and mostly missing, only trust it when it's set
+        lang = getattr(user, 'lang', None)
+        if lang and not lang.startswith('en'):
+            return 'language'
+        return None
+
+    def prescreen_users(self, users_list):
+        """
+        Resolve the users' profiles in batches of 100 and drop the users that are missing, protected,
+        have too few statuses or another profile language, before spending timeline requests on them.
+        Batches whose lookup failed are kept as is.
+        :return: list of the remaining user ids
+        """
+        if not users_list:
+            return users_list
+        batches = [users_list[i:i+LOOKUP_BATCH_SIZE] for i in range(0, len(users_list), LOOKUP_BATCH_SIZE)]
+        remaining = []
+        dropped = Counter()
+        with ThreadPoolExecutor(max_workers=self._n_threads) as executor:
+            for batch, users in zip(batches, executor.map(self._lookup_users, batches)):
+                if users is None:
+                    remaining.extend(batch)
+                    continue
+                users = {user.id_str: user for user in users}
+                for user_id in batch:
+                    reason = self._screen_user(users[user_id]) if user_id in users else 'not_found'
+                    if reason:
+                        self._skipped_users.add(user_id, reason)
+                        dropped[reason] += 1
+                    else:
+                        remaining.append(user_id)
+
+        for reason, count in dropped.items():
+            metrics.registry.inc('users_dropped_total', count, reason=reason)
+        # every dropped user would have cost at least one timeline request
+        saved = sum(dropped.values())
+        metrics.registry.inc('api_calls_saved_total', saved, endpoint='user_timeline')
+        print('Pre-screening dropped {dropped} of {total} users {reasons}, saving at least {saved} user_timeline '
+              'requests with {lookups} users/lookup requests'.format(
+                  dropped=saved, total=len(users_list), reasons=dict(dropped), saved=saved, lookups=len(batches)))
+        return remaining
 
     def get_user_tweets(self, user_id):
         """
         extract a user's recent timeline (200 recent tweets)
         :return: list of user tweets info
         """
+        with metrics.registry.timer('stage_seconds', stage='fetch_user'):
+            self._get_user_tweets(user_id)
+
+    def _get_user_tweets(self, user_id):
         english_tweets = []
         new_tweets = self._get_user_timeline(user_id=user_id, count=self._num_tweets)
 
-        while not new_tweets:
-            response = self._api.last_response
-            response_text = response.text
-            if 'error' in response_text:
-                if 'Rate limit exceeded' in response_text:
-                    time.sleep(5)
-                    new_tweets = self._get_user_timeline(user_id=user_id, count=self._num_tweets)
-                else:
-                    print("Skipping user {}".format(user_id))
-                    return
-            if 'Rate limit exceeded' in response_text or \
-                    'rate_limit_context' in response_text and \
-                    json.loads(response_text)['resources']['statuses']['/statuses/user_timeline']['remaining'] < 10:
-                print("Going to sleep for 10 minutes because we reached api rate limit")
-                time.sleep(10*60)
-                new_tweets = self._get_user_timeline(user_id=user_id, count=self._num_tweets)
-            if not new_tweets:
-                print("Skipping user {}".format(user_id))
-                return
+        if not new_tweets:
+            print("Skipping user {}".format(user_id))
+            # a failed request may succeed later, an empty timeline is unlikely to fill up soon
+            self._skip_user(user_id, 'error' if new_tweets is None else 'no_timeline')
+            return
 
         # keep grabbing tweets until we have enough
         while new_tweets and len(new_tweets) > 0 and len(english_tweets) < self._num_tweets:
@@ -152,9 +388,13 @@ class UserTweetFetcher:
         if len(english_tweets) < self._num_tweets:
             print("Skipping user {user_id} which has {tweet_count}/{tweet_threshold} valid tweets".format(
                 user_id=user_id, tweet_count=len(english_tweets), tweet_threshold=self._num_tweets))
+            self._skip_user(user_id, 'few_english_tweets')
             return
 
-        self.init_new_user(user_id)
+        user_data = {
+            'posts': [],
+            'hashtags': []
+        }
 
         for tweet in english_tweets[:self._num_tweets]:
             tweet_text = tweet.full_text.lower()
@@ -162,22 +402,14 @@ class UserTweetFetcher:
 
             if tweet_text:
                 created_at = tweet.created_at.timestamp()
-                self._users_tweets[user_id]['posts'].append((created_at, tweet_text))
-            self._users_tweets[user_id]['hashtags'].extend(hashtags)
+                user_data['posts'].append((created_at, tweet_text))
+            user_data['hashtags'].extend(hashtags)
 
+        with self._lock:
+            self._users_tweets.append(user_id, user_data)
+        metrics.registry.inc('users_fetched_total')
+        metrics.registry.inc('tweets_fetched_total', len(user_data['posts']))
         print('Finished with user {}'.format(user_id))
-        self._users_written += 1
-
-        if self._users_written % 200 == 0:
-            print('Saving after finished 200 users')
-            self.save_users()
-
-    def init_new_user(self, user_id):
-        if user_id not in self._users_tweets:
-            self._users_tweets[user_id] = {
-                'posts': [],
-                'hashtags': []
-            }
 
 
 if __name__ == '__main__':
@@ -185,11 +417,36 @@ if __name__ == '__main__':
     parser.add_argument('--users_paths', type=str, default='candidates.json', nargs='+',
                         help='Optional users path. This is the json file containing diagnosed schizophrenia users')
     parser.add_argument('--save_path', type=str, default='candidates_timeline.json',
-                        help='Optional save path. If this file already exists it is reloaded to avoid unnecessary work')
+                        help='Optional save path. The fetched users are exported to this json file when finished')
+    parser.add_argument('--store_path', type=str, default='candidates_timeline.jsonl',
+                        help='Optional store path. Every fetched user is appended to this file, '
+                             'if it already exists it is reloaded to avoid unnecessary work')
+    parser.add_argument('--export', action='store_true', default=False,
+                        help='Only export the users in store_path to save_path without fetching')
+    parser.add_argument('--columnar_path', type=str, default=None,
+                        help='Optional directory to also export the fetched users to in the columnar history format')
+    parser.add_argument('--n_threads', type=int, default=4, help='How many users to fetch concurrently')
     parser.add_argument('--oauth_config', type=str, default='config/oauth_config', help='Optional config file')
     parser.add_argument('--num_tweets', type=int, default=200, help='Minimum number of tweets per user')
     parser.add_argument('--raw_data', action='store_true', default=False,
-                        help='Whether users_paths are with json format or raw format which is a list of jsons')
+                        help='Whether users_paths are with json format or raw format which is a list of jsons. '
+                             'Raw files may be compressed or capture segment directories')
+    parser.add_argument('--skip_cache', type=str, default='skipped_users.jsonl',
+                        help='Optional skip cache path. Skipped users are appended to this file with the reason, '
+                             'and are not fetched again until the reason\'s TTL expires')
+    parser.add_argument('--skip_users', type=str, default=None,
+                        help='Optional file with a user id per line to never fetch, added to the skip cache')
+    parser.add_argument('--skip_stats', action='store_true', default=False,
+                        help='Only print the number of skipped users per reason')
+    parser.add_argument('--no_prescreen', action='store_true', default=False,
+                        help='Fetch every user\'s timeline without first looking up their profiles in batches')
+    parser.add_argument('--since', type=parse_date, default=None,
+                        help='Optional YYYY-MM-DD date, raw capture segments with only older tweets are skipped')
+    parser.add_argument('--until', type=parse_date, default=None,
+                        help='Optional YYYY-MM-DD date, raw capture segments with only newer tweets are skipped')
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='Optional metrics file, json if it ends with .json, Prometheus textfile format otherwise. '
+                             'It is refreshed periodically while fetching')
     options = parser.parse_args()
 
     tweet_fetcher = UserTweetFetcher(
@@ -197,12 +454,33 @@ if __name__ == '__main__':
         save_path=options.save_path,
         users_paths=options.users_paths,
         num_tweets=options.num_tweets,
-        raw_data=options.raw_data
+        raw_data=options.raw_data,
+        store_path=options.store_path,
+        n_threads=options.n_threads,
+        metrics_file=options.metrics,
+        since=options.since,
+        until=options.until,
+        prescreen=not options.no_prescreen,
+        skip_cache_path=options.skip_cache
     )
-    tweet_fetcher.create_api()
-
     try:
-        tweet_fetcher.get_tweets()
+        if options.skip_users:
+            tweet_fetcher.import_skip_users(options.skip_users)
+        if options.skip_stats:
+            tweet_fetcher.print_skip_stats()
+        elif options.export:
+            tweet_fetcher.save_users()
+            if options.columnar_path:
+                tweet_fetcher.save_users_columnar(options.columnar_path)
+        else:
+            tweet_fetcher.create_api()
+
+            try:
+                tweet_fetcher.get_tweets()
+            finally:
+                tweet_fetcher.save_users()
+                if options.columnar_path:
+                    tweet_fetcher.save_users_columnar(options.columnar_path)
+                print("Finished")
     finally:
-        tweet_fetcher.save_users()
-        print("Finished")
+        tweet_fetcher.close()
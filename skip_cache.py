@@ -0,0 +1,148 @@
+import json
+import os
+import threading
+import time
+from collections import Counter
+
+import fast_json
+
+DAY = 24 * 60 * 60
+
+# seconds a skipped user is not fetched again, by skip reason, None to never fetch again
+SKIP_TTLS = {
+    'manual': None,
+    'not_found': 30 * DAY,
+    'protected': 30 * DAY,
+    'language': 30 * DAY,
+    'few_statuses': 7 * DAY,
+    'few_english_tweets': 30 * DAY,
+    'no_timeline': 7 * DAY,
+    'error': 60 * 60,
+}
+
+# seconds a skip with a reason missing from SKIP_TTLS is kept, e.g. a reason since removed
+DEFAULT_SKIP_TTL = 7 * DAY
+
+
+class SkipCache:
+    """
+    Persistent cache of the users the fetcher skipped, with the reason and time they were skipped.
+    Each skip is appended to a json lines file and the cache is kept in memory as a dictionary,
+    so a user is checked in O(1) before any api request. A skip expires after the TTL of its reason,
+    after which the user is fetched again. Skips loaded with an unknown reason expire after DEFAULT_SKIP_TTL.
+    """
+    def __init__(self, path, ttls=None):
+        self._path = path
+        self._ttls = dict(SKIP_TTLS, **(ttls or {}))
+        self._skips = {}
+        self._lock = threading.Lock()
+        n_lines, n_malformed = self._load()
+        if n_malformed or n_lines > 2 * len(self._skips) + 1000:
+            self._compact()
+        self._out = open(self._path, 'a', encoding='utf-8')
+
+    @staticmethod
+    def _parse(line):
+        """
+        :return: tuple of (user_id, reason, skipped_at) of a skip line, or None if it's malformed
+        """
+        try:
+            user_id, reason, skipped_at = fast_json.loads(line)
+        except fast_json.DECODE_ERRORS + (TypeError,):
+            return None
+        if not isinstance(user_id, str) or not isinstance(reason, str) or not isinstance(skipped_at, (int, float)):
+            return None
+        return user_id, reason, skipped_at
+
+    def _load(self):
+        """
+        Load the skips, ignoring malformed lines, e.g. written when the disk was full,
+        and truncating a partially written line at the end of the file, like UserStore.
+        :return: tuple of (number of lines, number of malformed lines)
+        """
+        if not os.path.isfile(self._path):
+            return 0, 0
+        n_lines = 0
+        n_malformed = 0
+        offset = 0
+        with open(self._path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                n_lines += 1
+                skip = self._parse(line)
+                if skip is None:
+                    n_malformed += 1
+                    continue
+                user_id, reason, skipped_at = skip
+                self._skips[user_id] = (reason, skipped_at)
+
+        if offset != os.path.getsize(self._path):
+            print('Dropping a partially written skip at the end of {}'.format(self._path))
+            with open(self._path, 'r+b') as f:
+                f.truncate(offset)
+        if n_malformed:
+            print('Dropping {} malformed skips of {}'.format(n_malformed, self._path))
+        # expired skips are dropped on load
+        self._skips = {user_id: skip for user_id, skip in self._skips.items() if not self._expired(*skip)}
+        return n_lines, n_malformed
+
+    def _compact(self):
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as out:
+            for user_id, (reason, skipped_at) in self._skips.items():
+                out.write(json.dumps([user_id, reason, skipped_at]) + '\n')
+        os.replace(tmp_path, self._path)
+
+    def _expired(self, reason, skipped_at):
+        ttl = self._ttls.get(reason, DEFAULT_SKIP_TTL)
+        return ttl is not None and time.time() - skipped_at >= ttl
+
+    def __contains__(self, user_id):
+        skip = self._skips.get(user_id)
+        return skip is not None and not self._expired(*skip)
+
+    def reason(self, user_id):
+        """
+        :return: the reason a user is skipped, or None if they aren't
+        """
+        return self._skips[user_id][0] if user_id in self else None
+
+    def add(self, user_id, reason):
+        """
+        Skip a user until the TTL of the reason expires.
+        :param user_id: Twitter id of the user
+        :param reason: one of SKIP_TTLS' reasons, or of the reasons of the ttls the cache was created with
+        """
+        if reason not in self._ttls:
+            raise ValueError('Unknown skip reason {}'.format(reason))
+        skipped_at = time.time()
+        with self._lock:
+            self._skips[user_id] = (reason, skipped_at)
+            self._out.write(json.dumps([user_id, reason, skipped_at]) + '\n')
+            self._out.flush()
+
+    def import_users(self, path, reason='manual'):
+        """
+        Skip the users of a file with a user id per line, such as a hand maintained skip list.
+        :return: number of added users
+        """
+        with open(path, encoding='utf-8') as f:
+            user_ids = [line.strip() for line in f if line.strip()]
+        added = 0
+        for user_id in user_ids:
+            if user_id not in self:
+                self.add(user_id, reason)
+                added += 1
+        return added
+
+    def stats(self):
+        """
+        :return: Counter of the active skips per reason
+        """
+        return Counter(reason for user_id, (reason, skipped_at) in self._skips.items()
+                       if not self._expired(reason, skipped_at))
+
+    def close(self):
+        self._out.close()
@@ -1,10 +1,15 @@
 import re
 
+# regex syntax the pattern files don't use, patterns containing it are not merged into the trie
+_OTHER_REGEX_SYNTAX = re.compile(r'[\\^$*+?{}\[\]|()]')
+
 
 class TermSentiment:
     def __init__(self):
         self._positive_terms = self.load_positive_patterns()
         self._negative_terms = self.load_negative_patterns()
+        self._positive_matcher = self.compile_patterns(self._positive_terms)
+        self._negative_matcher = self.compile_patterns(self._negative_terms)
 
     @staticmethod
     def load_positive_patterns():
@@ -18,14 +23,86 @@ class TermSentiment:
             negative_patterns = f.read().splitlines()
         return negative_patterns
 
+    @staticmethod
+    def _tokenize_pattern(pattern):
+        """
+        Split a pattern into regex tokens: '.*', '.' and escaped literal characters.
+        Patterns using any other regex syntax are kept as a single token.
+        """
+        # a leading '.*' doesn't change whether a pattern is found in a text, but makes every search quadratic
+        while pattern.startswith('.*'):
+            pattern = pattern[2:]
+        if _OTHER_REGEX_SYNTAX.search(pattern.replace('.*', '').replace('.', '')):
+            return ['(?:{})'.format(pattern)]
+
+        tokens = []
+        i = 0
+        while i < len(pattern):
+            if pattern.startswith('.*', i):
+                tokens.append('.*')
+                i += 2
+            else:
+                tokens.append('.' if pattern[i] == '.' else re.escape(pattern[i]))
+                i += 1
+        return tokens
+
+    @staticmethod
+    def compile_patterns(patterns):
+        """
+        Compile all patterns into a single regex so a tweet is scanned once instead of once per pattern.
+        The patterns are merged into a trie on their common prefixes (most start with 'i ...'),
+        since the regex engine tries every branch of a flat alternation at every position of the tweet.
+        Each pattern ends with its own empty named group, which lets us tell which pattern matched.
+        :param patterns: list of regex patterns
+        :return: compiled regex
+        """
+        trie = {}
+        for i, pattern in enumerate(patterns):
+            node = trie
+            for token in TermSentiment._tokenize_pattern(pattern):
+                node = node.setdefault(token, {})
+            node.setdefault(None, i)
+
+        def to_regex(node):
+            branches = ['(?P<p{}>)'.format(node[None])] if None in node else []
+            branches += [token + to_regex(child) for token, child in node.items() if token is not None]
+            if len(branches) == 1:
+                return branches[0]
+            return '(?:{})'.format('|'.join(branches))
+
+        if not trie:
+            # nothing to match
+            return re.compile('(?!)')
+        return re.compile(to_regex(trie))
+
+    @staticmethod
+    def _find_term(matcher, terms, tweet_text):
+        match = matcher.search(tweet_text)
+        if not match:
+            return None
+        return terms[int(match.lastgroup[1:])]
+
+    def find_positive_term(self, tweet_text):
+        """
+        :return: the first positive pattern matching the tweet, or None
+        """
+        return self._find_term(self._positive_matcher, self._positive_terms, tweet_text)
+
+    def find_negative_term(self, tweet_text):
+        """
+        :return: the first negative pattern matching the tweet, or None
+        """
+        return self._find_term(self._negative_matcher, self._negative_terms, tweet_text)
+
+    def match_terms(self, tweet_text):
+        """
+        Match a tweet against both pattern sets.
+        :return: tuple of (matching positive pattern or None, matching negative pattern or None)
+        """
+        return self.find_positive_term(tweet_text), self.find_negative_term(tweet_text)
+
     def contains_positive_terms(self, tweet_text):
-        for positive_term in self._positive_terms:
-            if re.findall(positive_term, tweet_text):
-                return True
-        return False
+        return self._positive_matcher.search(tweet_text) is not None
 
     def contains_negative_terms(self, tweet_text):
-        for negative_term in self._negative_terms:
-            if re.findall(negative_term, tweet_text):
-                return True
-        return False
+        return self._negative_matcher.search(tweet_text) is not None
@@ -0,0 +1,36 @@
+import json
+import os
+import unittest
+
+from preprocess_tweets import Patterns
+
+# tweets covering the preprocessing steps' edge cases: urls, mentions, hashtags, emojis, smileys, numbers,
+# reserved words, mixed case and non ascii text, one json string per line
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'preprocess_corpus.jsonl')
+
+
+def load_corpus(path=CORPUS_PATH):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class TestPreprocess(unittest.TestCase):
+    def setUp(self):
+        self.corpus = load_corpus()
+
+    def test_corpus_covers_edge_cases(self):
+        for needle in ['http', '@', '#', '\U0001f600', 'RT ', ':)', '1948']:
+            self.assertTrue(any(needle in tweet for tweet in self.corpus), needle)
+        self.assertTrue(any(tweet != tweet.lower() and tweet != tweet.upper() for tweet in self.corpus))
+
+    def test_preprocess_many_matches_reference(self):
+        preprocessed = Patterns.preprocess_many(self.corpus)
+        self.assertEqual(len(preprocessed), len(self.corpus))
+        for tweet, result in zip(self.corpus, preprocessed):
+            with self.subTest(tweet=tweet):
+                self.assertEqual(result, Patterns._preprocess_reference(tweet))
+
+    def test_preprocess_matches_reference(self):
+        for tweet in self.corpus:
+            with self.subTest(tweet=tweet):
+                self.assertEqual(Patterns.preprocess(tweet), Patterns._preprocess_reference(tweet))
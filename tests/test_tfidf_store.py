@@ -0,0 +1,39 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from scipy.sparse import random as sparse_random
+
+from tfidf_store import TfidfStore
+
+
+class TestTfidfStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = TfidfStore(self.directory)
+        self.store.create_hashing(1000)
+        self.matrix = sparse_random(50, 1000, density=0.05, format='csr', random_state=0)
+        self.store.append_group('controls', [str(i) for i in range(30)], self.matrix[:30])
+        self.store.append_group('controls', [str(i) for i in range(30, 50)], self.matrix[30:])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_loaded_arrays_stay_memory_mapped(self):
+        ids, matrix = self.store.load_group('controls')
+        self.assertEqual(ids, [str(i) for i in range(50)])
+        self.assertEqual(matrix.shape, self.matrix.shape)
+        for array in [matrix.data, matrix.indices, matrix.indptr]:
+            self.assertIsInstance(array, np.memmap)
+
+    def test_select_rows(self):
+        _, matrix = self.store.load_group('controls')
+        rows = [49, 0, 31, 31, 7]
+        self.assertEqual((matrix[rows] != self.matrix[rows]).nnz, 0)
+        self.assertEqual(matrix[[]].shape, (0, 1000))
+
+    def test_missing_group_is_empty(self):
+        ids, matrix = self.store.load_group('schizos')
+        self.assertEqual(ids, [])
+        self.assertEqual(matrix.shape, (0, 1000))
@@ -0,0 +1,175 @@
+import json
+import os
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+# dtypes of the raw CSR arrays stored on disk
+DATA_DTYPE = np.float64
+INDEX_DTYPE = np.int64
+
+
+class StoredMatrix:
+    """
+    CSR matrix whose raw arrays are memory-mapped from a TfidfStore.
+    scipy's csr_matrix would copy the int64 index arrays into memory as int32, so the arrays are kept as they are
+    and only the selected rows are read into a csr matrix, by indexing or by reading a block of rows through
+    data, indices and indptr, see extract_matching_controls.row_block.
+    """
+    def __init__(self, data, indices, indptr, shape):
+        self.data = data
+        self.indices = indices
+        self.indptr = indptr
+        self.shape = shape
+
+    @property
+    def nnz(self):
+        return len(self.data)
+
+    def __getitem__(self, rows):
+        """
+        :param rows: list of row indices
+        :return: in-memory csr matrix of the rows, reading only their part of the arrays
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = np.asarray(self.indptr[rows])
+        lengths = np.asarray(self.indptr[rows + 1]) - starts
+        indptr = np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(lengths)])
+        positions = np.repeat(starts - indptr[:-1], lengths) + np.arange(indptr[-1])
+        return csr_matrix((np.asarray(self.data[positions]), np.asarray(self.indices[positions]), indptr),
+                          shape=(len(rows), self.shape[1]))
+
+
+class TfidfStore:
+    """
+    On-disk TF-IDF model and matrices.
+    The vocabulary is kept in vocabulary.json and the IDF weights in idf.npy.
+    Each group matrix (e.g. controls and schizos) is stored as raw CSR arrays which are memory-mapped when loaded
+    and can be appended to without rewriting them, with its user ids in a text file, one per line.
+    meta.json holds the row and non-zero counts of every group and is written last,
+    so an interrupted append is ignored on the next load.
+    A hashing store has no vocabulary, its matrices hold the hashed term counts and the IDF weights
+    are saved once all documents are counted.
+    """
+    def __init__(self, directory):
+        self._directory = directory
+
+    def _path(self, name):
+        return os.path.join(self._directory, name)
+
+    def exists(self):
+        return os.path.isfile(self._path('meta.json'))
+
+    def _read_meta(self):
+        with open(self._path('meta.json')) as f:
+            return json.load(f)
+
+    def _write_meta(self, meta):
+        tmp_path = self._path('meta.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self._path('meta.json'))
+
+    def save_model(self, vectorizer):
+        """
+        Save a fitted vectorizer and drop all stored matrices, which were computed with the previous model.
+        """
+        os.makedirs(self._directory, exist_ok=True)
+        with open(self._path('vocabulary.json'), 'w', encoding='utf-8') as f:
+            json.dump({term: int(index) for term, index in vectorizer.vocabulary_.items()}, f)
+        np.save(self._path('idf.npy'), vectorizer.idf_)
+        self._write_meta({'n_features': len(vectorizer.vocabulary_), 'groups': {}})
+
+    def create_hashing(self, n_features):
+        """
+        Start an empty hashing store and drop all stored matrices.
+        """
+        os.makedirs(self._directory, exist_ok=True)
+        self._write_meta({'n_features': n_features, 'hashing': True, 'groups': {}})
+
+    def is_hashing(self):
+        return self._read_meta().get('hashing', False)
+
+    def save_idf(self, idf):
+        np.save(self._path('idf.npy'), idf)
+
+    def load_idf(self):
+        return np.load(self._path('idf.npy'))
+
+    def load_model(self):
+        with open(self._path('vocabulary.json'), encoding='utf-8') as f:
+            vocabulary = json.load(f)
+        vectorizer = TfidfVectorizer(vocabulary=vocabulary)
+        vectorizer.idf_ = np.load(self._path('idf.npy'))
+        return vectorizer
+
+    def group_ids(self, name):
+        meta = self._read_meta()
+        if name not in meta['groups']:
+            return []
+        with open(self._path('{}_ids.txt'.format(name)), encoding='utf-8') as f:
+            return f.read().splitlines()[:meta['groups'][name]['rows']]
+
+    @staticmethod
+    def _map(path, dtype, length):
+        if not length:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', shape=(length,))
+
+    def load_group(self, name):
+        """
+        :return: tuple of (list of user ids, StoredMatrix with a row per user)
+        """
+        meta = self._read_meta()
+        rows = meta['groups'].get(name, {'rows': 0, 'nnz': 0})
+        data = self._map(self._path('{}_data.bin'.format(name)), DATA_DTYPE, rows['nnz'])
+        indices = self._map(self._path('{}_indices.bin'.format(name)), INDEX_DTYPE, rows['nnz'])
+        indptr = self._map(self._path('{}_indptr.bin'.format(name)), INDEX_DTYPE, rows['rows'] + 1) \
+            if rows['rows'] else np.zeros(1, dtype=INDEX_DTYPE)
+        return self.group_ids(name), StoredMatrix(data, indices, indptr, (rows['rows'], meta['n_features']))
+
+    def append_group(self, name, ids, matrix):
+        """
+        Append rows to a group matrix.
+        :param name: group name
+        :param ids: user ids of the new rows
+        :param matrix: csr matrix of the new rows
+        """
+        meta = self._read_meta()
+        rows = meta['groups'].get(name, {'rows': 0, 'nnz': 0, 'ids_bytes': 0})
+        matrix = csr_matrix(matrix)
+        matrix.sort_indices()
+        if 'ids_bytes' not in rows:
+            # stores written before the size of the ids file was kept
+            rows['ids_bytes'] = len(''.join('{}\n'.format(user_id) for user_id in self.group_ids(name)).encode('utf-8'))
+
+        # drop whatever an interrupted append left after the committed lengths
+        files = [
+            ('{}_data.bin'.format(name), rows['nnz'] * np.dtype(DATA_DTYPE).itemsize),
+            ('{}_indices.bin'.format(name), rows['nnz'] * np.dtype(INDEX_DTYPE).itemsize),
+            ('{}_indptr.bin'.format(name), (rows['rows'] + 1 if rows['rows'] else 0) * np.dtype(INDEX_DTYPE).itemsize),
+            ('{}_ids.txt'.format(name), rows['ids_bytes']),
+        ]
+        for file_name, size in files:
+            with open(self._path(file_name), 'ab') as f:
+                f.truncate(size)
+
+        indptr = matrix.indptr.astype(INDEX_DTYPE) + rows['nnz']
+        if rows['rows']:
+            # the first entry is already stored as the end of the last row
+            indptr = indptr[1:]
+        with open(self._path('{}_data.bin'.format(name)), 'ab') as f:
+            f.write(matrix.data.astype(DATA_DTYPE).tobytes())
+        with open(self._path('{}_indices.bin'.format(name)), 'ab') as f:
+            f.write(matrix.indices.astype(INDEX_DTYPE).tobytes())
+        with open(self._path('{}_indptr.bin'.format(name)), 'ab') as f:
+            f.write(indptr.tobytes())
+
+        new_ids = ''.join('{}\n'.format(user_id) for user_id in ids).encode('utf-8')
+        with open(self._path('{}_ids.txt'.format(name)), 'ab') as f:
+            f.write(new_ids)
+
+        meta['groups'][name] = {'rows': rows['rows'] + matrix.shape[0], 'nnz': rows['nnz'] + matrix.nnz,
+                                'ids_bytes': rows['ids_bytes'] + len(new_ids)}
+        self._write_meta(meta)
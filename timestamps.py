@@ -0,0 +1,28 @@
+import calendar
+import time
+from functools import lru_cache
+
+CREATED_AT_FORMAT = '%a %b %d %H:%M:%S +0000 %Y'
+MONTHS = {month: i for i, month in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'], 1)}
+
+
+@lru_cache(maxsize=4096)
+def _day_timestamp(year, month, day):
+    return calendar.timegm((year, month, day, 0, 0, 0))
+
+
+def parse_created_at(created_at):
+    """
+    Parse a Twitter created_at string, e.g. 'Wed Jan 02 14:03:07 +0000 2019', as UTC.
+    The fixed width fields are sliced directly and the start of each day is cached,
+    since a capture only spans a few days; anything unexpected falls back to strptime.
+    :return: unix timestamp as a float
+    """
+    try:
+        if len(created_at) == 30 and created_at[19:26] == ' +0000 ':
+            return float(_day_timestamp(int(created_at[26:]), MONTHS[created_at[4:7]], int(created_at[8:10])) +
+                         int(created_at[11:13]) * 3600 + int(created_at[14:16]) * 60 + int(created_at[17:19]))
+    except (KeyError, ValueError):
+        pass
+    return float(calendar.timegm(time.strptime(created_at, CREATED_AT_FORMAT)))
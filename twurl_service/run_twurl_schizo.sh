@@ -1 +1,4 @@
-twurl -H stream.twitter.com -A "Accept-encoding: none" -d "track=schizophrenia,schizophrenic,paranoid schizophrenia,paranoid schizophrenic,schiizophrenia,schitzo,schitzophrenia,schizo,schizofrenia,schizophernia,schizophren,schizophrene,schizophrenia,schizophrenia disorder,schizophreniak,schizophrenic,schizophrenic dis,schizophrenic disorder,schizophrenic narcissism,schyzophrenia,scizophrenia,shizophrenia,shizophrenic,skitsafrantic,skitzafrenic,skitzophrenia,unspecified schizophrenia" -X POST "/1.1/statuses/filter.json" >> /home/tapuz/psych/psych.SMHD_new
+# the filter stream is written to rotated, compressed segments in /home/tapuz/psych/capture,
+# the previous single file capture /home/tapuz/psych/psych.SMHD_new can still be read as a plain input
+SCHIZO_DS=${SCHIZO_DS:-/home/tapuz/psych/Schizo_DS}
+twurl -H stream.twitter.com -A "Accept-encoding: none" -d "track=schizophrenia,schizophrenic,paranoid schizophrenia,paranoid schizophrenic,schiizophrenia,schitzo,schitzophrenia,schizo,schizofrenia,schizophernia,schizophren,schizophrene,schizophrenia,schizophrenia disorder,schizophreniak,schizophrenic,schizophrenic dis,schizophrenic disorder,schizophrenic narcissism,schyzophrenia,scizophrenia,shizophrenia,shizophrenic,skitsafrantic,skitzafrenic,skitzophrenia,unspecified schizophrenia" -X POST "/1.1/statuses/filter.json" | python3 "$SCHIZO_DS/capture_segments.py" --output /home/tapuz/psych/capture --compression zstd
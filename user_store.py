@@ -0,0 +1,120 @@
+import json
+import os
+
+import fast_json
+import metrics
+
+# every record line starts with this prefix followed by the JSON encoded user id
+_ID_PREFIX = '{"id": '
+
+
+class UserStore:
+    """
+    Append-only store of fetched users.
+    Every finished user is appended as a single JSON line, so saving costs one small write
+    and a crash can at most lose the line being written.
+    Only an index of user id to line offset is kept in memory.
+    A readonly store can be opened while the fetcher is still appending to the file.
+    Records are fsynced one by one unless sync is False, for bulk writes of data which can be rebuilt.
+    """
+    def __init__(self, path, readonly=False, sync=True):
+        self._path = path
+        self._readonly = readonly
+        self._sync = sync
+        self._index = {}
+        self._decoder = json.JSONDecoder()
+        self._build_index()
+        self._out = None if readonly else open(self._path, 'ab')
+
+    def _build_index(self):
+        if not os.path.isfile(self._path):
+            return
+
+        offset = 0
+        with open(self._path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                # only the id at the start of the line is decoded
+                user_id, _ = self._decoder.raw_decode(line.decode('utf-8'), len(_ID_PREFIX))
+                self._index[user_id] = (offset, len(line))
+                offset += len(line)
+
+        if offset != os.path.getsize(self._path) and not self._readonly:
+            print('Dropping a partially written record at the end of {}'.format(self._path))
+            with open(self._path, 'r+b') as f:
+                f.truncate(offset)
+
+    def __contains__(self, user_id):
+        return user_id in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def user_ids(self):
+        return list(self._index.keys())
+
+    def append(self, user_id, user_data):
+        """
+        Persist a user. If the user is already stored, the new record replaces it.
+        :param user_id: Twitter id of the user
+        :param user_data: dictionary with the user's 'posts' and 'hashtags'
+        """
+        line = _ID_PREFIX + json.dumps(user_id) + ', "data": ' + json.dumps(user_data) + '}\n'
+        line = line.encode('utf-8')
+        offset = self._out.seek(0, os.SEEK_END)
+        self._out.write(line)
+        if self._sync:
+            self._out.flush()
+            os.fsync(self._out.fileno())
+        self._index[user_id] = (offset, len(line))
+        metrics.registry.inc('bytes_written_total', len(line), file=os.path.basename(self._path))
+
+    def get(self, user_id):
+        offset, length = self._index[user_id]
+        if self._out:
+            self._out.flush()
+        with open(self._path, 'rb') as f:
+            f.seek(offset)
+            return fast_json.loads(f.read(length))['data']
+
+    def items(self, skip=()):
+        """
+        :param skip: optional user ids whose records are not read
+        :return: generator of (user_id, user_data) in insertion order, reading one record at a time
+        """
+        if self._out:
+            self._out.flush()
+        with open(self._path, 'rb') as f:
+            for user_id, (offset, length) in self._index.items():
+                if user_id in skip:
+                    continue
+                f.seek(offset)
+                yield user_id, fast_json.loads(f.read(length))['data']
+
+    def import_json(self, json_path):
+        """
+        Append the users of a JSON file in the legacy {user_id: user_data} format.
+        """
+        users = fast_json.load_file(json_path)
+        for user_id, user_data in users.items():
+            if user_id not in self._index:
+                self.append(user_id, user_data)
+
+    def export_json(self, json_path):
+        """
+        Write the stored users in the legacy {user_id: user_data} format, as produced by json.dump.
+        """
+        with open(json_path, 'w', encoding='utf-8') as out:
+            out.write('{')
+            for i, (user_id, user_data) in enumerate(self.items()):
+                if i:
+                    out.write(', ')
+                out.write(json.dumps(user_id))
+                out.write(': ')
+                out.write(json.dumps(user_data))
+            out.write('}')
+
+    def close(self):
+        if self._out:
+            self._out.close()